@@ -1,8 +1,16 @@
+import bisect
+import io
 import json
+import os
 import random
+import tarfile
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from safetensors import safe_open
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg, read_file
+import torchvision.transforms.functional as TF
 from PIL import Image
 from transformers import CLIPImageProcessor
 
@@ -16,8 +24,26 @@ class VDDataset(Dataset):
             tokenizer,
             size=512,
             image_root_path="",
+            feature_dir=None,
+            pretokenize=False,
+            gpu_decode=False,
     ):
 
+        # precompute_features.py 로 만든 latent / embedding shard 를 읽는 모드
+        self.feature_dir = feature_dir
+        if feature_dir is not None:
+            with open(os.path.join(feature_dir, "index.json"), 'r') as file:
+                self.feature_index = json.load(file)
+            self.shard_offsets = [0]
+            for shard in self.feature_index["shards"]:
+                self.shard_offsets.append(self.shard_offsets[-1] + shard["num_samples"])
+            self._shard_files = {}
+            self._shard_captions = {}
+            self._shard_cloth_files = {}
+            self._null_features = None
+            print('=========', len(self))
+            return
+
         if isinstance(json_file, str):
             with open(json_file, 'r') as file:
                 self.data = json.load(file)
@@ -35,7 +61,14 @@ class VDDataset(Dataset):
 
         print('=========', len(self.data))
 
+        self._init_transforms(tokenizer, size, image_root_path, gpu_decode)
+        if pretokenize:
+            self.pretokenize_captions()
+
+    def _init_transforms(self, tokenizer, size, image_root_path, gpu_decode=False):
         self.tokenizer = tokenizer
+        self.caption_tokens = None
+        self.gpu_decode = gpu_decode
         self.size = size
         self.image_root_path = image_root_path
 
@@ -48,15 +81,132 @@ class VDDataset(Dataset):
 
         self.clip_image_processor = CLIPImageProcessor()
 
+    def pretokenize_captions(self, batch_size=4096):
+        # 모든 caption 을 한 번만 tokenize 해 int32 토큰 배열 + offset 으로 보관 (CLIP vocab 은 int16 범위를 넘음)
+        texts = [text for item in self.data for text in item['text']]
+        tokens = []
+        for i in range(0, len(texts), batch_size):
+            tokens.extend(self.tokenizer(
+                texts[i:i + batch_size],
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+            ).input_ids)
+
+        self.caption_tokens = np.fromiter((t for ids in tokens for t in ids), dtype=np.int32)
+        self.caption_offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        self.caption_offsets[1:] = np.cumsum([len(ids) for ids in tokens])
+        self.item_caption_offsets = np.zeros(len(self.data) + 1, dtype=np.int64)
+        self.item_caption_offsets[1:] = np.cumsum([len(item['text']) for item in self.data])
+        self.null_caption_tokens = np.asarray(self.tokenizer(
+            "",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+        ).input_ids, dtype=np.int32)
+
+    def caption_input_ids(self, caption_ids):
+        """
+        Padded `input_ids` of the caption indices returned in pretokenize mode, -1 is the empty caption.
+        """
+        input_ids = np.full((len(caption_ids), self.tokenizer.model_max_length), self.tokenizer.pad_token_id,
+                            dtype=np.int64)
+        for i, caption_id in enumerate(caption_ids.tolist()):
+            if caption_id < 0:
+                tokens = self.null_caption_tokens
+            else:
+                tokens = self.caption_tokens[self.caption_offsets[caption_id]:self.caption_offsets[caption_id + 1]]
+            input_ids[i, :len(tokens)] = tokens
+        return torch.from_numpy(input_ids)
+
+    def _open_shard(self, file_name):
+        # opened lazily so every DataLoader worker gets its own handles
+        if file_name not in self._shard_files:
+            f = safe_open(os.path.join(self.feature_dir, file_name), framework="pt", device="cpu")
+            self._shard_files[file_name] = f
+            metadata = f.metadata()
+            self._shard_captions[file_name] = json.loads(metadata["captions"])
+            # older shards have no garment list and crop every sample's garment independently
+            self._shard_cloth_files[file_name] = json.loads(metadata["cloth_files"]) \
+                if "cloth_files" in metadata else None
+        return self._shard_files[file_name]
+
+    def _null_feature(self, name):
+        if self._null_features is None:
+            with safe_open(os.path.join(self.feature_dir, self.feature_index["null_file"]), framework="pt",
+                           device="cpu") as f:
+                self._null_features = {k: f.get_tensor(k)[0] for k in f.keys()}
+        return self._null_features[name]
+
+    def get_features(self, idx):
+        shard_id = bisect.bisect_right(self.shard_offsets, idx) - 1
+        row = idx - self.shard_offsets[shard_id]
+        file_name = self.feature_index["shards"][shard_id]["file"]
+        f = self._open_shard(file_name)
+
+        # same random choices as the image path: caption and drops from random, crops from torch
+        caption_start, caption_end = f.get_slice("caption_offsets")[row:row + 2].tolist()
+        caption_id = random.randrange(caption_start, caption_end)
+        text = self._shard_captions[file_name][caption_id]
+
+        drop_image_embed = 0
+        rand_num = random.random()
+        if rand_num < 0.05:
+            drop_image_embed = 1
+        elif rand_num < 0.1:
+            text = ""
+        elif rand_num < 0.15:
+            text = ""
+            drop_image_embed = 1
+
+        num_crops = self.feature_index["num_crops"]
+        person_crop, clothes_crop = torch.randint(num_crops, (2,)).tolist()
+        person_moments = f.get_slice("person_moments")[row:row + 1, person_crop:person_crop + 1][0, 0]
+        clothes_moments = f.get_slice("clothes_moments")[row:row + 1, clothes_crop:clothes_crop + 1][0, 0]
+
+        cloth_files = self._shard_cloth_files[file_name]
+        garment = cloth_files[row] if cloth_files is not None else idx
+
+        if drop_image_embed == 1:
+            image_embeds = self._null_feature("image_embeds")
+        else:
+            image_embeds = f.get_slice("image_embeds")[row:row + 1][0]
+        if text == "":
+            encoder_hidden_states = self._null_feature("text_embeds")
+        else:
+            encoder_hidden_states = f.get_slice("caption_embeds")[caption_id:caption_id + 1][0]
+
+        return {
+            "person_moments": person_moments,
+            "clothes_moments": clothes_moments,
+            "image_embeds": image_embeds,
+            "drop_image_embed": drop_image_embed,
+            "text": text,
+            "encoder_hidden_states": encoder_hidden_states,
+            # identifies the garment crop, e.g. for caching reference UNet features, shared by the pairs of a garment
+            "clothes_key": f"{garment}:{clothes_crop}",
+        }
+
     def __getitem__(self, idx):
+        if self.feature_dir is not None:
+            return self.get_features(idx)
+
         item = self.data[idx]
 
         person_path = item["image_file"]
-        person_img = Image.open(person_path).convert("RGB")
         cloth_path = item["cloth_file"]
-        clothes_img = Image.open(cloth_path).convert("RGB")
+        if self.gpu_decode:
+            person_img = read_file(person_path)
+            clothes_img = read_file(cloth_path)
+        else:
+            person_img = Image.open(person_path).convert("RGB")
+            clothes_img = Image.open(cloth_path).convert("RGB")
 
-        text = choice(item['text'])
+        caption_start = self.item_caption_offsets[idx] if self.caption_tokens is not None else None
+        return self.make_sample(person_img, clothes_img, item['text'], caption_start)
+
+    def make_sample(self, person_img, clothes_img, texts, caption_start=None):
+        # choice over indices draws the same random numbers as choice(texts)
+        text_index = choice(range(len(texts)))
+        text = texts[text_index]
 
         drop_image_embed = 0
         rand_num = random.random()
@@ -68,6 +218,28 @@ class VDDataset(Dataset):
             text = ""
             drop_image_embed = 1
 
+        if self.gpu_decode:
+            # still encoded, decoded and augmented batch-wise on the GPU by BatchImageDecoder
+            images = {
+                "person_bytes": person_img,
+                "clothes_bytes": clothes_img,
+            }
+        else:
+            images = {
+                "vae_person": self.transform(person_img),
+                "vae_clothes": self.transform(clothes_img),
+                "clip_image": self.clip_image_processor(images=clothes_img, return_tensors="pt").pixel_values,
+            }
+
+        if caption_start is not None:
+            # only the caption index goes back through the DataLoader, see caption_input_ids
+            return {
+                **images,
+                "drop_image_embed": drop_image_embed,
+                "text": text,
+                "caption_id": -1 if text == "" else int(caption_start) + text_index,
+            }
+
         text_input_ids = self.tokenizer(
             text,
             max_length=self.tokenizer.model_max_length,
@@ -84,15 +256,8 @@ class VDDataset(Dataset):
             return_tensors="pt"
         ).input_ids
 
-        vae_person = self.transform(person_img)
-        vae_clothes = self.transform(clothes_img)
-
-        clip_image = self.clip_image_processor(images=clothes_img, return_tensors="pt").pixel_values
-
         return {
-            "vae_person": vae_person,
-            "vae_clothes": vae_clothes,
-            "clip_image": clip_image,
+            **images,
             "drop_image_embed": drop_image_embed,
             "text": text,
             "text_input_ids": text_input_ids,
@@ -100,26 +265,243 @@ class VDDataset(Dataset):
         }
 
     def __len__(self):
+        if self.feature_dir is not None:
+            return self.shard_offsets[-1]
         return len(self.data)
 
 
+def read_shard(path):
+    # tar 를 순차로 읽으며 같은 key 의 person / cloth / caption 을 한 sample 로 묶음
+    with tarfile.open(path, mode="r|") as tar:
+        sample, key = {}, None
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, ext = member.name.split(".", 1)
+            if key is not None and member_key != key:
+                yield sample
+                sample = {}
+            key = member_key
+            sample[ext] = tar.extractfile(member).read()
+        if sample:
+            yield sample
+
+
+class VDShardDataset(IterableDataset, VDDataset):
+    r"""
+    Streaming reader of the tar shards written by `make_igpair_shards.py`. Every rank reads whole shards
+    sequentially, shards are reshuffled per epoch and split over ranks and DataLoader workers, and samples are
+    shuffled inside a small buffer.
+
+    Args:
+        shard_dir (`str`):
+            Directory holding `index.json` and the shards.
+        tokenizer (`CLIPTokenizer`):
+            Tokenizer of the captions.
+        rank (`int`, defaults to 0):
+            Rank of this process, as passed to `DistributedSampler`.
+        world_size (`int`, defaults to 1):
+            Number of processes.
+        shuffle_buffer (`int`, defaults to 256):
+            Number of samples, still JPEG encoded, a worker shuffles among.
+        seed (`int`, defaults to 0):
+            Seed of the shard order, shared by every rank.
+        gpu_decode (`bool`, defaults to False):
+            Return the JPEG bytes for `BatchImageDecoder` instead of decoded tensors.
+    """
+
+    def __init__(
+            self,
+            shard_dir,
+            tokenizer,
+            size=512,
+            image_root_path="",
+            rank=0,
+            world_size=1,
+            shuffle_buffer=256,
+            seed=0,
+            gpu_decode=False,
+    ):
+        with open(os.path.join(shard_dir, "index.json"), 'r') as file:
+            self.shards = json.load(file)["shards"]
+        self.shard_dir = shard_dir
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        if len(self.shards) < world_size:
+            # a rank without its own shard would have to re-read another rank's samples
+            raise ValueError(f"{shard_dir} has {len(self.shards)} shards, fewer than the {world_size} processes, "
+                             f"rewrite it with a smaller --shard_size")
+
+        # every rank yields the same number of samples so no rank waits on the others at the end of an epoch
+        self.num_samples = sum(shard["num_samples"] for shard in self.shards) // world_size
+        print('=========', len(self))
+
+        self._init_transforms(tokenizer, size, image_root_path, gpu_decode)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _worker_shards(self):
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        shards = shards[self.rank::self.world_size]
+
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        if len(self.shards) // self.world_size < num_workers:
+            raise ValueError(f"{len(self.shards)} shards can't be split over {self.world_size} processes with "
+                             f"{num_workers} DataLoader workers each, lower --dataloader_num_workers or rewrite "
+                             f"the shards with a smaller --shard_size")
+        num_samples = self.num_samples // num_workers + (worker_id < self.num_samples % num_workers)
+        return shards[worker_id::num_workers], num_samples, worker_id
+
+    def _raw_samples(self, shards):
+        if not shards:
+            raise ValueError(f"no shards to read in {self.shard_dir}")
+        # a worker whose shards are short of its share wraps around them
+        while True:
+            for shard in shards:
+                yield from read_shard(os.path.join(self.shard_dir, shard["file"]))
+
+    def __iter__(self):
+        shards, num_samples, worker_id = self._worker_shards()
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * 1009 + worker_id)
+
+        buffer = []
+        raw_samples = self._raw_samples(shards)
+        for _ in range(num_samples):
+            while len(buffer) < self.shuffle_buffer:
+                buffer.append(next(raw_samples))
+            raw = buffer.pop(rng.randrange(len(buffer)))
+
+            if self.gpu_decode:
+                person_img = torch.frombuffer(bytearray(raw["person.jpg"]), dtype=torch.uint8)
+                clothes_img = torch.frombuffer(bytearray(raw["cloth.jpg"]), dtype=torch.uint8)
+            else:
+                person_img = Image.open(io.BytesIO(raw["person.jpg"])).convert("RGB")
+                clothes_img = Image.open(io.BytesIO(raw["cloth.jpg"])).convert("RGB")
+            yield self.make_sample(person_img, clothes_img, json.loads(raw["json"])["text"])
+
+    def __len__(self):
+        return self.num_samples
+
+
+
+# 압축된 이미지 batch 를 GPU 에서 decode 하고 VDDataset.transform / CLIPImageProcessor 와 같은 전처리 수행
+class BatchImageDecoder:
+    r"""
+    Decodes the `person_bytes` / `clothes_bytes` of a `gpu_decode` batch on `device` with nvJPEG and applies the
+    training augmentation there: Resize(512), RandomCrop([640, 512]) and Normalize for the VAE inputs, and the
+    CLIP resize / center crop / normalize for the garment. Images nvJPEG can't decode, and every image when
+    `device` is not a GPU, are decoded on the CPU instead.
+
+    Args:
+        clip_image_processor (`CLIPImageProcessor`):
+            Processor whose size, crop size, mean and std are reproduced.
+        device (`torch.device`):
+            Device the batch is decoded on and returned on.
+        size (`int`, defaults to 512):
+            Short side the images are resized to before cropping.
+        crop_size (`tuple`, defaults to (640, 512)):
+            Height and width of the random crop.
+    """
+
+    def __init__(self, clip_image_processor, device, size=512, crop_size=(640, 512)):
+        self.device = torch.device(device)
+        self.size = size
+        self.crop_size = crop_size
+        self.use_nvjpeg = self.device.type == "cuda"
+
+        clip_size = clip_image_processor.size
+        self.clip_size = clip_size["shortest_edge"] if isinstance(clip_size, dict) else clip_size
+        clip_crop_size = clip_image_processor.crop_size
+        self.clip_crop_size = [clip_crop_size["height"], clip_crop_size["width"]] \
+            if isinstance(clip_crop_size, dict) else clip_crop_size
+        self.clip_mean = torch.tensor(clip_image_processor.image_mean, device=self.device).view(3, 1, 1)
+        self.clip_std = torch.tensor(clip_image_processor.image_std, device=self.device).view(3, 1, 1)
+
+    def decode(self, data):
+        if self.use_nvjpeg:
+            try:
+                return decode_jpeg(data, mode=ImageReadMode.RGB, device=self.device)
+            except RuntimeError:
+                pass
+        return decode_image(data, mode=ImageReadMode.RGB).to(self.device)
+
+    def vae_image(self, image):
+        image = TF.resize(image.float(), self.size, interpolation=transforms.InterpolationMode.BILINEAR,
+                          antialias=True).round_().clamp_(0, 255)
+        # same draws as transforms.RandomCrop.get_params
+        height, width = self.crop_size
+        top = torch.randint(0, image.shape[-2] - height + 1, size=(1,)).item()
+        left = torch.randint(0, image.shape[-1] - width + 1, size=(1,)).item()
+        image = image[:, top:top + height, left:left + width]
+        return image / 127.5 - 1.
+
+    def clip_image(self, image):
+        image = TF.resize(image.float(), self.clip_size, interpolation=transforms.InterpolationMode.BICUBIC,
+                          antialias=True).round_().clamp_(0, 255)
+        image = TF.center_crop(image, self.clip_crop_size)
+        return (image / 255. - self.clip_mean) / self.clip_std
+
+    def __call__(self, batch):
+        person_images = [self.decode(data) for data in batch["person_bytes"]]
+        clothes_images = [self.decode(data) for data in batch["clothes_bytes"]]
+        return {
+            "vae_person": torch.stack([self.vae_image(image) for image in person_images]),
+            "vae_clothes": torch.stack([self.vae_image(image) for image in clothes_images]),
+            "clip_image": torch.stack([self.clip_image(image) for image in clothes_images]),
+        }
+
+
 def collate_fn(data):
-    vae_person = torch.stack([example["vae_person"] for example in data]).to(
-        memory_format=torch.contiguous_format).float()
-    vae_clothes = torch.stack([example["vae_clothes"] for example in data]).to(
-        memory_format=torch.contiguous_format).float()
+    if "person_moments" in data[0]:
+        return {
+            "person_moments": torch.stack([example["person_moments"] for example in data]),
+            "clothes_moments": torch.stack([example["clothes_moments"] for example in data]),
+            "image_embeds": torch.stack([example["image_embeds"] for example in data]),
+            "drop_image_embed": [example["drop_image_embed"] for example in data],
+            "text": [example["text"] for example in data],
+            "encoder_hidden_states": torch.stack([example["encoder_hidden_states"] for example in data]),
+            "clothes_key": [example["clothes_key"] for example in data],
+        }
 
-    clip_image = torch.cat([example["clip_image"] for example in data], dim=0)
+    if "person_bytes" in data[0]:
+        images = {
+            "person_bytes": [example["person_bytes"] for example in data],
+            "clothes_bytes": [example["clothes_bytes"] for example in data],
+        }
+    else:
+        vae_person = torch.stack([example["vae_person"] for example in data]).to(
+            memory_format=torch.contiguous_format).float()
+        vae_clothes = torch.stack([example["vae_clothes"] for example in data]).to(
+            memory_format=torch.contiguous_format).float()
+
+        clip_image = torch.cat([example["clip_image"] for example in data], dim=0)
+        images = {
+            "vae_person": vae_person,
+            "vae_clothes": vae_clothes,
+            "clip_image": clip_image,
+        }
     drop_image_embed = [example["drop_image_embed"] for example in data]
 
     text = [example["text"] for example in data]
+    if "caption_id" in data[0]:
+        return {
+            **images,
+            "drop_image_embed": drop_image_embed,
+            "text": text,
+            "caption_ids": torch.tensor([example["caption_id"] for example in data], dtype=torch.int64),
+        }
+
     input_ids = torch.cat([example["text_input_ids"] for example in data], dim=0)
     null_input_ids = torch.cat([example["null_text_input_ids"] for example in data], dim=0)
 
     return {
-        "vae_person": vae_person,
-        "vae_clothes": vae_clothes,
-        "clip_image": clip_image,
+        **images,
         "drop_image_embed": drop_image_embed,
         "text": text,
         "input_ids": input_ids,
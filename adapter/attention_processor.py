@@ -1,3 +1,4 @@
+import math
 from typing import Callable, Optional, Union
 
 import torch
@@ -9,6 +10,157 @@ from diffusers.models.lora import LoRALinearLayer
 
 
 
+# reference hidden states 를 K/V 로 projection 후 head 단위로 reshape
+# 의상 feature 가 바뀌지 않는 한 모든 step / 같은 의상의 요청에서 재사용 가능
+def prepare_ref_key_value(processor, attn, ref_hidden_states):
+    batch_size = ref_hidden_states.shape[0]
+    ref_key, ref_value = _ref_key_value(processor, ref_hidden_states)
+    head_dim = ref_key.shape[-1] // attn.heads
+    ref_key = ref_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    ref_value = ref_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    return ref_key, ref_value
+
+
+# reference 브랜치 attention 계산 후 hidden_states 에 더함
+# ref_batch_slice 가 주어지면 해당 배치 구간(CFG 의 조건부 절반)에만 적용
+def _add_ref_attention(processor, attn, hidden_states, query, ref_hidden_states, attention_mask, head_dim,
+                       ref_batch_slice=None, ref_key_value=None):
+    if ref_batch_slice is not None:
+        query = query[ref_batch_slice]
+        if attention_mask is not None:
+            attention_mask = attention_mask[ref_batch_slice]
+    ref_batch_size = query.shape[0]
+
+    if ref_key_value is None:
+        ref_key_value = prepare_ref_key_value(processor, attn, ref_hidden_states)
+    ref_key, ref_value = ref_key_value
+
+    # the output of sdp = (batch, num_heads, seq_len, head_dim)
+    # TODO: add support for attn.scale when we move to Torch 2.1
+    ref_hidden_states = F.scaled_dot_product_attention(
+        query, ref_key, ref_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+    )
+    ref_hidden_states = ref_hidden_states.transpose(1, 2).reshape(ref_batch_size, -1, attn.heads * head_dim)
+    ref_hidden_states = ref_hidden_states.to(query.dtype)
+
+    if ref_batch_slice is None:
+        return hidden_states + ref_hidden_states * processor.scale
+    # only the conditional slice of a fused CFG batch sees the reference features
+    hidden_states[ref_batch_slice] = hidden_states[ref_batch_slice] + ref_hidden_states * processor.scale
+    return hidden_states
+
+
+# self attention 과 reference attention 을 합쳐 계산
+# processor.ref_attn_mode:
+#   "sum"     : self / reference 각각 SDPA 후 scale 을 곱해 더함 (기본값, 원래 동작)
+#   "concat"  : key/value 를 이어 붙여 SDPA 한 번, scale 은 ref 쪽 logit bias log(scale) 로 적용 (근사)
+def _ref_self_attention(processor, attn, query, key, value, attention_mask, head_dim, ref_hidden_states=None,
+                        ref_batch_slice=None, ref_key_value=None):
+    batch_size = query.shape[0]
+    # precomputed ref K/V stand in for the reference hidden states, which are then not passed at all
+    has_ref = ref_hidden_states is not None or ref_key_value is not None
+    mode = getattr(processor, "ref_attn_mode", "sum") if has_ref else "sum"
+
+    if mode == "concat" and attention_mask is None:
+        if ref_key_value is None:
+            ref_key_value = prepare_ref_key_value(processor, attn, ref_hidden_states)
+        ref_key, ref_value = ref_key_value
+        ref_slice = ref_batch_slice if ref_batch_slice is not None else slice(None)
+
+        # joint softmax over [self, ref], only the rows in ref_batch_slice are computed with the reference
+        ref_bias = math.log(processor.scale) if processor.scale > 0 else float("-inf")
+        logit_bias = query.new_zeros(1, 1, 1, key.shape[2] + ref_key.shape[2])
+        logit_bias[:, :, :, key.shape[2]:] = ref_bias
+        ref_out = F.scaled_dot_product_attention(
+            query[ref_slice], torch.cat([key[ref_slice], ref_key], dim=2),
+            torch.cat([value[ref_slice], ref_value], dim=2),
+            attn_mask=logit_bias, dropout_p=0.0, is_causal=False
+        )
+        if ref_batch_slice is None:
+            hidden_states = ref_out
+        else:
+            # the remaining (unconditional) rows only attend to themselves
+            self_rows = torch.ones(batch_size, dtype=torch.bool, device=query.device)
+            self_rows[ref_batch_slice] = False
+            hidden_states = ref_out.new_empty((batch_size,) + ref_out.shape[1:])
+            hidden_states[self_rows] = F.scaled_dot_product_attention(
+                query[self_rows], key[self_rows], value[self_rows], dropout_p=0.0, is_causal=False
+            )
+            hidden_states[ref_batch_slice] = ref_out
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        return hidden_states.to(query.dtype)
+
+    # TODO: add support for attn.scale when we move to Torch 2.1
+    hidden_states = F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+    )
+
+    hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+    hidden_states = hidden_states.to(query.dtype)
+
+    if has_ref:
+        hidden_states = _add_ref_attention(
+            processor, attn, hidden_states, query, ref_hidden_states, attention_mask, head_dim,
+            ref_batch_slice=ref_batch_slice, ref_key_value=ref_key_value,
+        )
+    return hidden_states
+
+
+# LoRA delta 를 base weight 에 합치고 여러 projection 을 하나의 weight 로 묶음 (inference 전용)
+@torch.no_grad()
+def _fuse_linear_weights(linears, loras=None, lora_scale=1.0):
+    weights, biases = [], []
+    for i, linear in enumerate(linears):
+        weight = linear.weight.float()
+        if loras is not None:
+            lora = loras[i]
+            delta = lora.up.weight.float() @ lora.down.weight.float()
+            if lora.network_alpha is not None:
+                delta = delta * (lora.network_alpha / lora.rank)
+            weight = weight + lora_scale * delta
+        weights.append(weight)
+        biases.append(linear.bias)
+
+    weight = torch.cat(weights).to(linears[0].weight.dtype)
+    if all(bias is None for bias in biases):
+        return weight, None
+    bias = torch.cat([
+        bias if bias is not None else torch.zeros(linear.out_features, device=weight.device, dtype=weight.dtype)
+        for linear, bias in zip(linears, biases)
+    ]).to(weight.dtype)
+    return weight, bias
+
+
+# lora_scale 별 fused weight (최대 2 세트) 캐시
+def _cached_fused_weights(cache, lora_scale, fuse):
+    if lora_scale not in cache:
+        if len(cache) >= 2:
+            # oldest scale goes first, a sweep over many scales still only keeps two merged copies
+            cache.pop(next(iter(cache)))
+        cache[lora_scale] = fuse()
+    return cache[lora_scale]
+
+
+def _compatible_lora_delta(linears, hidden_states, args):
+    # LoRACompatibleLinear.forward(x, scale) adds scale * lora_layer(x), the fused weights only hold linear.weight
+    if not args or all(getattr(linear, "lora_layer", None) is None for linear in linears):
+        return None
+    return torch.cat([
+        args[0] * linear.lora_layer(hidden_states) if getattr(linear, "lora_layer", None) is not None
+        else hidden_states.new_zeros(hidden_states.shape[:-1] + (linear.out_features,))
+        for linear in linears
+    ], dim=-1)
+
+
+def _ref_key_value(processor, ref_hidden_states):
+    if getattr(processor, "fuse_projections", False):
+        # to_k_ref / to_v_ref packed into one GEMM
+        if processor._fused_ref_weight is None:
+            processor._fused_ref_weight, _ = _fuse_linear_weights([processor.to_k_ref, processor.to_v_ref])
+        return F.linear(ref_hidden_states, processor._fused_ref_weight).chunk(2, dim=-1)
+    return processor.to_k_ref(ref_hidden_states), processor.to_v_ref(ref_hidden_states)
+
+
 # attention 최적화, 효율적 처리, 캐시 처리로 실행 속도, 성능 개선
 class CacheAttnProcessor2_0:
     r"""
@@ -125,6 +277,8 @@ class SAttnProcessor2_0(torch.nn.Module):
             scale: float = 1.0,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
     ) -> torch.FloatTensor:
         residual = hidden_states
         if attn.spatial_norm is not None:
@@ -227,6 +381,8 @@ class CAttnProcessor2_0(torch.nn.Module):
             scale: float = 1.0,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
     ) -> torch.FloatTensor:
         residual = hidden_states
         if attn.spatial_norm is not None:
@@ -321,6 +477,8 @@ class BaseSAttnProcessor2_0(torch.nn.Module):
             scale: float = 1.0,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
     ) -> torch.FloatTensor:
 
         residual = hidden_states
@@ -408,6 +566,7 @@ class LoraRefSAttnProcessor2_0(torch.nn.Module):
         self.to_k_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.scale = scale
+        self.ref_attn_mode = "sum"  # "sum" or "concat"
 
         self.rank = rank
         self.lora_scale = lora_scale
@@ -427,6 +586,8 @@ class LoraRefSAttnProcessor2_0(torch.nn.Module):
             num_images_per_prompt=1,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
 
     ) -> torch.FloatTensor:
         residual = hidden_states
@@ -473,32 +634,14 @@ class LoraRefSAttnProcessor2_0(torch.nn.Module):
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
-        # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        # for ref adapter, the reference branch is combined according to self.ref_attn_mode
+        hidden_states = _ref_self_attention(
+            self, attn, query, key, value, attention_mask, head_dim,
+            sa_hidden_states.get(self.name) if sa_hidden_states is not None else None,
+            ref_batch_slice=ref_batch_slice,
+            ref_key_value=ref_key_values.get(self.name) if ref_key_values is not None else None,
         )
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-        hidden_states = hidden_states.to(query.dtype)
-
-        # for ref adapter
-        if sa_hidden_states is not None:
-            ref_hidden_states = sa_hidden_states[self.name]
-            # for ref
-            ref_key = self.to_k_ref(ref_hidden_states)
-            ref_value = self.to_v_ref(ref_hidden_states)
-            ref_key = ref_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-            ref_value = ref_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-            # the output of sdp = (batch, num_heads, seq_len, head_dim)
-            # TODO: add support for attn.scale when we move to Torch 2.1
-            ref_hidden_states = F.scaled_dot_product_attention(
-                query, ref_key, ref_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-            )
-            ref_hidden_states = ref_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-            ref_hidden_states = ref_hidden_states.to(query.dtype)
-            hidden_states = hidden_states + ref_hidden_states * self.scale
-
         # linear proj
         hidden_states = attn.to_out[0](hidden_states) + self.lora_scale * self.to_out_lora(hidden_states)
         # dropout
@@ -531,6 +674,7 @@ class RefSAttnProcessor2_0(torch.nn.Module):
         self.to_k_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.scale = scale
+        self.ref_attn_mode = "sum"  # "sum" or "concat"
 
     def __call__(
             self,
@@ -543,6 +687,8 @@ class RefSAttnProcessor2_0(torch.nn.Module):
             num_images_per_prompt=1,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
 
     ) -> torch.FloatTensor:
         residual = hidden_states
@@ -589,32 +735,14 @@ class RefSAttnProcessor2_0(torch.nn.Module):
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
-        # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        # for ref adapter, the reference branch is combined according to self.ref_attn_mode
+        hidden_states = _ref_self_attention(
+            self, attn, query, key, value, attention_mask, head_dim,
+            sa_hidden_states.get(self.name) if sa_hidden_states is not None else None,
+            ref_batch_slice=ref_batch_slice,
+            ref_key_value=ref_key_values.get(self.name) if ref_key_values is not None else None,
         )
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-        hidden_states = hidden_states.to(query.dtype)
-
-        # for ref adapter
-        if sa_hidden_states is not None:
-            ref_hidden_states = sa_hidden_states[self.name]
-            # for ref
-            ref_key = self.to_k_ref(ref_hidden_states)
-            ref_value = self.to_v_ref(ref_hidden_states)
-            ref_key = ref_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-            ref_value = ref_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-            # the output of sdp = (batch, num_heads, seq_len, head_dim)
-            # TODO: add support for attn.scale when we move to Torch 2.1
-            ref_hidden_states = F.scaled_dot_product_attention(
-                query, ref_key, ref_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-            )
-            ref_hidden_states = ref_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-            ref_hidden_states = ref_hidden_states.to(query.dtype)
-            hidden_states = hidden_states + ref_hidden_states * self.scale
-
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
         # dropout
@@ -649,6 +777,7 @@ class RefCAttnProcessor2_0(torch.nn.Module):
         self.to_k_ref = nn.Linear(hidden_size, hidden_size, bias=False)
         self.to_v_ref = nn.Linear(hidden_size, hidden_size, bias=False)
         self.scale = scale
+        self.ref_attn_mode = "sum"  # "sum" or "concat"
 
     def __call__(
             self,
@@ -660,6 +789,8 @@ class RefCAttnProcessor2_0(torch.nn.Module):
             scale: float = 1.0,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
     ) -> torch.FloatTensor:
 
         residual = hidden_states
@@ -705,32 +836,14 @@ class RefCAttnProcessor2_0(torch.nn.Module):
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
-        # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        # for ref adapter, the reference branch is combined according to self.ref_attn_mode
+        hidden_states = _ref_self_attention(
+            self, attn, query, key, value, attention_mask, head_dim,
+            sa_hidden_states.get(self.name) if sa_hidden_states is not None else None,
+            ref_batch_slice=ref_batch_slice,
+            ref_key_value=ref_key_values.get(self.name) if ref_key_values is not None else None,
         )
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-        hidden_states = hidden_states.to(query.dtype)
-
-        # for ref adapter
-        if sa_hidden_states is not None:
-            ref_hidden_states = sa_hidden_states[self.name]
-            # for ref
-            ref_key = self.to_k_ref(ref_hidden_states)
-            ref_value = self.to_v_ref(ref_hidden_states)
-            ref_key = ref_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-            ref_value = ref_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-            # the output of sdp = (batch, num_heads, seq_len, head_dim)
-            # TODO: add support for attn.scale when we move to Torch 2.1
-            ref_hidden_states = F.scaled_dot_product_attention(
-                query, ref_key, ref_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-            )
-            ref_hidden_states = ref_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-            ref_hidden_states = ref_hidden_states.to(query.dtype)
-            hidden_states = hidden_states + ref_hidden_states * self.scale
-
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
         # dropout
@@ -782,6 +895,38 @@ class LoRAIPAttnProcessor2_0(nn.Module):
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
 
+        self.fuse_projections = False
+        self._fused_weights = {}
+
+    # inference 전용: LoRA 를 합친 q / fused text KV / fused ip KV / out projection 사용
+    def enable_fused_projections(self):
+        self.fuse_projections = True
+
+    def disable_fused_projections(self):
+        self.fuse_projections = False
+        self._fused_weights = {}
+
+    def _fuse_weights(self, attn):
+        q_weight, q_bias = _fuse_linear_weights([attn.to_q], [self.to_q_lora], self.lora_scale)
+        kv_weight, kv_bias = _fuse_linear_weights(
+            [attn.to_k, attn.to_v], [self.to_k_lora, self.to_v_lora], self.lora_scale
+        )
+        ip_kv_weight, _ = _fuse_linear_weights([self.to_k_ip, self.to_v_ip])
+        out_weight, out_bias = _fuse_linear_weights([attn.to_out[0]], [self.to_out_lora], self.lora_scale)
+        return {
+            "q_weight": q_weight,
+            "q_bias": q_bias,
+            "kv_weight": kv_weight,
+            "kv_bias": kv_bias,
+            "ip_kv_weight": ip_kv_weight,
+            "out_weight": out_weight,
+            "out_bias": out_bias,
+        }
+
+    def _get_fused_weights(self, attn):
+        # one merged set per lora_scale, switching back and forth between two scales never re-merges
+        return _cached_fused_weights(self._fused_weights, self.lora_scale, lambda: self._fuse_weights(attn))
+
     def __call__(
             self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, scale=1.0, temb=None, *args,
             **kwargs,
@@ -805,7 +950,12 @@ class LoRAIPAttnProcessor2_0(nn.Module):
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states) + self.lora_scale * self.to_q_lora(hidden_states)
+        fused = self.fuse_projections and encoder_hidden_states is not None
+        if fused:
+            fused_weights = self._get_fused_weights(attn)
+            query = F.linear(hidden_states, fused_weights["q_weight"], fused_weights["q_bias"])
+        else:
+            query = attn.to_q(hidden_states) + self.lora_scale * self.to_q_lora(hidden_states)
         # query = attn.head_to_batch_dim(query)
 
         if encoder_hidden_states is None:
@@ -821,8 +971,13 @@ class LoRAIPAttnProcessor2_0(nn.Module):
                 encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
         # for text
-        key = attn.to_k(encoder_hidden_states) + self.lora_scale * self.to_k_lora(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states) + self.lora_scale * self.to_v_lora(encoder_hidden_states)
+        if fused:
+            key, value = F.linear(
+                encoder_hidden_states, fused_weights["kv_weight"], fused_weights["kv_bias"]
+            ).chunk(2, dim=-1)
+        else:
+            key = attn.to_k(encoder_hidden_states) + self.lora_scale * self.to_k_lora(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states) + self.lora_scale * self.to_v_lora(encoder_hidden_states)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -842,8 +997,11 @@ class LoRAIPAttnProcessor2_0(nn.Module):
         hidden_states = hidden_states.to(query.dtype)
 
         # for ip
-        ip_key = self.to_k_ip(ip_hidden_states)
-        ip_value = self.to_v_ip(ip_hidden_states)
+        if fused:
+            ip_key, ip_value = F.linear(ip_hidden_states, fused_weights["ip_kv_weight"]).chunk(2, dim=-1)
+        else:
+            ip_key = self.to_k_ip(ip_hidden_states)
+            ip_value = self.to_v_ip(ip_hidden_states)
 
         ip_key = ip_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
         ip_value = ip_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
@@ -860,7 +1018,10 @@ class LoRAIPAttnProcessor2_0(nn.Module):
         hidden_states = hidden_states + self.scale * ip_hidden_states
 
         # linear proj
-        hidden_states = attn.to_out[0](hidden_states) + self.lora_scale * self.to_out_lora(hidden_states)
+        if fused:
+            hidden_states = F.linear(hidden_states, fused_weights["out_weight"], fused_weights["out_bias"])
+        else:
+            hidden_states = attn.to_out[0](hidden_states) + self.lora_scale * self.to_out_lora(hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
 
@@ -1026,6 +1187,7 @@ class RefLoraSAttnProcessor2_0(torch.nn.Module):
         self.to_k_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ref = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.scale = scale
+        self.ref_attn_mode = "sum"  # "sum" or "concat"
 
         self.rank = rank
         self.lora_scale = lora_scale
@@ -1034,6 +1196,35 @@ class RefLoraSAttnProcessor2_0(torch.nn.Module):
         self.to_v_lora = LoRALinearLayer(cross_attention_dim or hidden_size, hidden_size, rank, network_alpha)
         self.to_out_lora = LoRALinearLayer(hidden_size, hidden_size, rank, network_alpha)
 
+        self.fuse_projections = False
+        self._fused_weights = {}
+        self._fused_ref_weight = None
+
+    # inference 전용: LoRA 를 합친 fused QKV / out / ref KV projection 사용
+    def enable_fused_projections(self):
+        self.fuse_projections = True
+
+    def disable_fused_projections(self):
+        self.fuse_projections = False
+        self._fused_weights = {}
+        self._fused_ref_weight = None
+
+    def _fuse_weights(self, attn):
+        qkv_weight, qkv_bias = _fuse_linear_weights(
+            [attn.to_q, attn.to_k, attn.to_v], [self.to_q_lora, self.to_k_lora, self.to_v_lora], self.lora_scale
+        )
+        out_weight, out_bias = _fuse_linear_weights([attn.to_out[0]], [self.to_out_lora], self.lora_scale)
+        return {
+            "qkv_weight": qkv_weight,
+            "qkv_bias": qkv_bias,
+            "out_weight": out_weight,
+            "out_bias": out_bias,
+        }
+
+    def _get_fused_weights(self, attn):
+        # one merged set per lora_scale, switching back and forth between two scales never re-merges
+        return _cached_fused_weights(self._fused_weights, self.lora_scale, lambda: self._fuse_weights(attn))
+
     def __call__(
             self,
             attn,
@@ -1045,6 +1236,8 @@ class RefLoraSAttnProcessor2_0(torch.nn.Module):
             num_images_per_prompt=1,
             cond_hidden_states=None,
             sa_hidden_states=None,
+            ref_batch_slice=None,
+            ref_key_values=None,
 
     ) -> torch.FloatTensor:
         residual = hidden_states
@@ -1071,16 +1264,26 @@ class RefLoraSAttnProcessor2_0(torch.nn.Module):
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
         args = () if USE_PEFT_BACKEND else (scale,)
-        query = attn.to_q(hidden_states, *args) + self.lora_scale * self.to_q_lora(hidden_states)
+        fused = self.fuse_projections and encoder_hidden_states is None
+        if fused:
+            fused_weights = self._get_fused_weights(attn)
+            qkv = F.linear(hidden_states, fused_weights["qkv_weight"], fused_weights["qkv_bias"])
+            # the scale argument still reaches the LoRA layers of the base projections, as in the unfused path
+            delta = _compatible_lora_delta([attn.to_q, attn.to_k, attn.to_v], hidden_states, args)
+            if delta is not None:
+                qkv = qkv + delta
+            query, key, value = qkv.chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states, *args) + self.lora_scale * self.to_q_lora(hidden_states)
 
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
+            if encoder_hidden_states is None:
+                encoder_hidden_states = hidden_states
 
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+            elif attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states, *args) + self.lora_scale * self.to_k_lora(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states, *args) + self.lora_scale * self.to_v_lora(encoder_hidden_states)
+            key = attn.to_k(encoder_hidden_states, *args) + self.lora_scale * self.to_k_lora(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states, *args) + self.lora_scale * self.to_v_lora(encoder_hidden_states)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -1091,34 +1294,22 @@ class RefLoraSAttnProcessor2_0(torch.nn.Module):
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
-        # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        # for ref adapter, the reference branch is combined according to self.ref_attn_mode
+        hidden_states = _ref_self_attention(
+            self, attn, query, key, value, attention_mask, head_dim,
+            sa_hidden_states.get(self.name) if sa_hidden_states is not None else None,
+            ref_batch_slice=ref_batch_slice,
+            ref_key_value=ref_key_values.get(self.name) if ref_key_values is not None else None,
         )
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-        hidden_states = hidden_states.to(query.dtype)
-
-        # for ref adapter
-        if sa_hidden_states is not None:
-            ref_hidden_states = sa_hidden_states[self.name]
-            # for ref
-            ref_key = self.to_k_ref(ref_hidden_states)
-            ref_value = self.to_v_ref(ref_hidden_states)
-            ref_key = ref_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-            ref_value = ref_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
-            # the output of sdp = (batch, num_heads, seq_len, head_dim)
-            # TODO: add support for attn.scale when we move to Torch 2.1
-            ref_hidden_states = F.scaled_dot_product_attention(
-                query, ref_key, ref_value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-            )
-            ref_hidden_states = ref_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
-            ref_hidden_states = ref_hidden_states.to(query.dtype)
-            hidden_states = hidden_states + ref_hidden_states * self.scale
-
         # linear proj
-        hidden_states = attn.to_out[0](hidden_states, *args) + self.lora_scale * self.to_out_lora(hidden_states)
+        if fused:
+            delta = _compatible_lora_delta([attn.to_out[0]], hidden_states, args)
+            hidden_states = F.linear(hidden_states, fused_weights["out_weight"], fused_weights["out_bias"])
+            if delta is not None:
+                hidden_states = hidden_states + delta
+        else:
+            hidden_states = attn.to_out[0](hidden_states, *args) + self.lora_scale * self.to_out_lora(hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
 
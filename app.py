@@ -7,6 +7,7 @@ from modelscope.outputs import OutputKeys
 from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
 from dressing_sd.pipelines.IMAGDressing_v1_pipeline_ipa_controlnet import IMAGDressing_v1
+from dressing_sd.pipelines.request_batcher import TryOnBatcher
 from diffusers.pipelines.stable_diffusion import StableDiffusionSafetyChecker
 from torchvision import transforms
 import cv2
@@ -31,9 +32,12 @@ from typing import List
 import torch
 
 import argparse
+import json
 import os
+import threading
 
 from controlnet_aux import OpenposeDetector
+from preprocess.openpose.pose_cache import PoseMapCache, render_pose_keypoints
 from insightface.app import FaceAnalysis
 from insightface.utils import face_align
 
@@ -43,6 +47,11 @@ parser.add_argument('--if_ipa', type=bool, default=True)
 parser.add_argument('--if_control', type=bool, default=True)
 parser.add_argument('--model_weight', type=str, required=True)
 parser.add_argument('--server_port', type=int, required=True)
+parser.add_argument('--max_batch_size', type=int, default=4)
+parser.add_argument('--max_wait', type=float, default=0.05, help='seconds a request may wait to be batched')
+parser.add_argument('--fuse_attn', action='store_true', help='fold LoRA deltas into fused attention projections')
+parser.add_argument('--ref_attn_mode', type=str, default='sum', choices=['sum', 'concat'])
+parser.add_argument('--pose_cache_size', type=int, default=256)
 args = parser.parse_args()
 
 
@@ -146,6 +155,8 @@ img_transform = transforms.Compose([
 ])
 
 openpose_model = OpenposeDetector.from_pretrained('lllyasviel/ControlNet').to(args.device)
+# pose library images are detected once, later requests reuse the rendered map
+pose_cache = PoseMapCache(openpose_model, max_items=args.pose_cache_size)
 
 unet.requires_grad_(False)
 ref_unet.requires_grad_(False)
@@ -153,6 +164,24 @@ image_encoder.requires_grad_(False)
 vae.requires_grad_(False)
 text_encoder.requires_grad_(False)
 
+# build the pipeline once at startup, ip_ckpt is loaded and ProjPlusModel initialised only here
+pipe = IMAGDressing_v1(unet=unet, reference_unet=ref_unet, vae=vae, tokenizer=tokenizer,
+                       text_encoder=text_encoder, image_encoder=image_encoder,
+                       ip_ckpt='./ckpt/ip-adapter-faceid-plus_sd15.bin',
+                       ImgProj=image_proj, controlnet=control_net_openpose,
+                       scheduler=noise_scheduler,
+                       safety_checker=StableDiffusionSafetyChecker,
+                       feature_extractor=CLIPImageProcessor)
+if args.fuse_attn:
+    pipe.fuse_attn_projections()
+pipe.set_ref_attn_mode(args.ref_attn_mode)
+# concurrent clicks sharing resolution / steps / scales are denoised together
+batcher = TryOnBatcher(pipe, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+image_face_fusion = pipeline('face_fusion_torch', model='damo/cv_unet_face_fusion_torch', model_revision='v1.0.0')
+clip_image_processor = CLIPImageProcessor()
+# guards the per-request models above, which concurrent Gradio workers would otherwise share
+preprocess_lock = threading.Lock()
+
 
 def resize_img(input_image, max_side=640, min_side=512, size=None, 
                pad_to_max_side=False, mode=Image.BILINEAR, base_pixel_number=64):
@@ -168,59 +197,53 @@ def resize_img(input_image, max_side=640, min_side=512, size=None,
 
 
 def dress_process(garm_img, face_img, pose_img, prompt, cloth_guidance_scale, caption_guidance_scale,
-                  face_guidance_scale, self_guidance_scale, cross_guidance_scale, if_ipa, if_postprocess,  if_control, denoise_steps, seed=42):
-    image_face_fusion = pipeline('face_fusion_torch', model='damo/cv_unet_face_fusion_torch',model_revision='v1.0.0')
+                  face_guidance_scale, self_guidance_scale, cross_guidance_scale, if_ipa, if_postprocess,  if_control, denoise_steps, seed=42,
+                  pose_keypoints=None):
     if prompt is None:
         prompt = "a photography of a model"
     prompt = prompt + ', best quality, high quality'
     print(prompt, cloth_guidance_scale, if_ipa, if_control, denoise_steps, seed)
-    clip_image_processor = CLIPImageProcessor()
 
     if not garm_img:
         raise gr.Error("请上传衣服 / Please upload garment")
-    clothes_img = resize_img(garm_img)
-    vae_clothes = img_transform(clothes_img).unsqueeze(0)
-    ref_clip_image = clip_image_processor(images=clothes_img, return_tensors="pt").pixel_values
-
-    if if_ipa:
-        faces = app.get(face_img)
-        if not faces:
-            raise gr.Error("人脸检测异常，尝试其他肖像 / Abnormal face detection. Try another portrait")
-        faceid_embeds = torch.from_numpy(faces[0].normed_embedding).unsqueeze(0)
-        face_image = face_align.norm_crop(face_img, landmark=faces[0].kps, image_size=224) # you can also segment the face
+    # face analysis, pose detection and the processors are not thread safe, only the batcher call runs concurrently
+    with preprocess_lock:
+        clothes_img = resize_img(garm_img)
+        vae_clothes = img_transform(clothes_img).unsqueeze(0)
+        ref_clip_image = clip_image_processor(images=clothes_img, return_tensors="pt").pixel_values
+
+        if if_ipa:
+            faces = app.get(face_img)
+            if not faces:
+                raise gr.Error("人脸检测异常，尝试其他肖像 / Abnormal face detection. Try another portrait")
+            faceid_embeds = torch.from_numpy(faces[0].normed_embedding).unsqueeze(0)
+            face_image = face_align.norm_crop(face_img, landmark=faces[0].kps, image_size=224) # you can also segment the face
         
 
-        face_clip_image = clip_image_processor(images=face_image, return_tensors="pt").pixel_values
-    else:
-        faceid_embeds = None
-        face_clip_image = None
-
-    if if_control:
-        pose_img = openpose_model(pose_img.convert("RGB"))
-        # pose_img.save('pose.png')
-        pose_image = diffusers.utils.load_image(pose_img)
-    else:
-        pose_image = None
-
-    noise_scheduler = DDIMScheduler(
-        num_train_timesteps=1000,
-        beta_start=0.00085,
-        beta_end=0.012,
-        beta_schedule="scaled_linear",
-        clip_sample=False,
-        set_alpha_to_one=False,
-        steps_offset=1,
-    )
-
-    pipe = IMAGDressing_v1(unet=unet, reference_unet=ref_unet, vae=vae, tokenizer=tokenizer,
-                            text_encoder=text_encoder, image_encoder=image_encoder,
-                            ip_ckpt='./ckpt/ip-adapter-faceid-plus_sd15.bin',
-                            ImgProj=image_proj, controlnet=control_net_openpose,
-                            scheduler=noise_scheduler,
-                            safety_checker=StableDiffusionSafetyChecker,
-                            feature_extractor=CLIPImageProcessor)
+            face_clip_image = clip_image_processor(images=face_image, return_tensors="pt").pixel_values
+        else:
+            faceid_embeds = None
+            face_clip_image = None
+
+        if if_control:
+            if pose_keypoints:
+                # 18-point keypoints (JSON) are rendered directly, no body network
+                try:
+                    pose_img = render_pose_keypoints(json.loads(pose_keypoints), width=512, height=640)
+                except (json.JSONDecodeError, KeyError, IndexError, ValueError, TypeError):
+                    raise gr.Error("姿势关键点格式错误，需要 18 个身体关键点 / Invalid pose keypoints, expected 18 body keypoints as JSON")
+            else:
+                if pose_img is None:
+                    raise gr.Error("请上传姿势图片 / Please upload pose image or pose keypoints")
+                pose_img = pose_cache(pose_img)["pose_map"]
+            # pose_img.save('pose.png')
+            pose_image = diffusers.utils.load_image(pose_img)
+        else:
+            pose_image = None
+
+    # the pipeline is long-lived, __call__ resets scheduler timesteps and attention scales per request
     generator = torch.Generator(args.device).manual_seed(seed) if seed is not None else None
-    output = pipe(
+    output = batcher(
         ref_image=vae_clothes,
         prompt=prompt,
         ref_clip_image=ref_clip_image,
@@ -239,18 +262,19 @@ def dress_process(garm_img, face_img, pose_img, prompt, cloth_guidance_scale, ca
         c_lora_scale= cross_guidance_scale,
         generator=generator,
         num_inference_steps=denoise_steps,
-    ).images
+    )
     
     if if_postprocess and if_ipa:
 
-        output_array = np.array(output[0])
+        output_array = np.array(output)
 
         bgr_array = cv2.cvtColor(output_array, cv2.COLOR_RGB2BGR)
 
         bgr_image = Image.fromarray(bgr_array)
-        result = image_face_fusion(dict(template=bgr_image, user=Image.fromarray(face_image.astype('uint8'))))
+        with preprocess_lock:
+            result = image_face_fusion(dict(template=bgr_image, user=Image.fromarray(face_image.astype('uint8'))))
         return result[OutputKeys.OUTPUT_IMG]
-    return output[0]
+    return output
 
 
 example_path = os.path.join(os.path.dirname(__file__), 'assets')
@@ -267,7 +291,7 @@ pose_list_path = [os.path.join(example_path,"pose",pose) for pose in pose_list]
 def process_image(image):
     return image
 
-image_blocks = gr.Blocks().queue()
+image_blocks = gr.Blocks().queue(default_concurrency_limit=args.max_batch_size)
 with image_blocks as demo:
     gr.Markdown("## IMAGDressing-v1: Customizable Virtual Dressing 👕👔👚")
     gr.Markdown(
@@ -351,8 +375,11 @@ with image_blocks as demo:
             with gr.Row():
                 denoise_steps = gr.Number(label="Denoising Steps", minimum=20, maximum=50, value=30, step=1)
                 seed = gr.Number(label="Seed", minimum=-1, maximum=2147483647, step=1, value=20240508)
+            with gr.Row():
+                pose_keypoints = gr.Textbox(placeholder='18-point pose keypoints JSON ex) {"pose_keypoints_2d": [[x, y], ...], "width": 512, "height": 640}',
+                                            label="Pose keypoints", elem_id="pose-keypoints")
 
-    try_button.click(fn=dress_process, inputs=[garm_img, imgs, pose_img, prompt, cloth_guidance_scale, caption_guidance_scale, face_guidance_scale, self_guidance_scale, cross_guidance_scale, is_checked_face, is_checked_postprocess, is_checked_pose, denoise_steps, seed],
+    try_button.click(fn=dress_process, inputs=[garm_img, imgs, pose_img, prompt, cloth_guidance_scale, caption_guidance_scale, face_guidance_scale, self_guidance_scale, cross_guidance_scale, is_checked_face, is_checked_postprocess, is_checked_pose, denoise_steps, seed, pose_keypoints],
                      outputs=[image_out], api_name='IMAGDressing-v1')
 
 image_blocks.launch(server_port=args.server_port)  #
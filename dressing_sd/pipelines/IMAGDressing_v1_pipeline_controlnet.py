@@ -16,7 +16,7 @@ import sys
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 
-from adapter.attention_processor import RefSAttnProcessor2_0
+from adapter.attention_processor import RefSAttnProcessor2_0, prepare_ref_key_value
 
 
 class IMAGDressing_v1(StableDiffusionControlNetPipeline):
@@ -356,6 +356,32 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                                                                uncond_clip_image_embeds)
         return image_prompt_embeds, uncond_image_prompt_embeds
 
+    # reference UNet 은 실제로 사용되는 조건부 배치만 계산, 각 self-attention 층의 hidden states 반환
+    def extract_reference_hidden_states(self, ref_image_latents, ref_prompt_embeds, timestep):
+        _ = self.reference_unet(
+            ref_image_latents,
+            timestep,
+            encoder_hidden_states=ref_prompt_embeds,
+            return_dict=False,
+        )
+
+        # get cache tensors, popped so the processors do not keep them alive
+        sa_hidden_states = {}
+        for name, attn_processor in self.reference_unet.attn_processors.items():
+            sa_hidden_states[name] = attn_processor.cache.pop("hidden_states")
+        return sa_hidden_states
+
+    # denoising UNet 의 reference K/V projection 을 한 번만 계산 (모든 step 에서 재사용)
+    def prepare_ref_key_values(self, sa_hidden_states):
+        ref_key_values = {}
+        for module in self.unet.modules():
+            attn_processor = getattr(module, "processor", None)
+            if hasattr(attn_processor, "to_k_ref") and attn_processor.name in sa_hidden_states:
+                ref_key_values[attn_processor.name] = prepare_ref_key_value(
+                    attn_processor, module, sa_hidden_states[attn_processor.name]
+                )
+        return ref_key_values
+
     def set_scale(self, scale):
         for attn_processor in self.unet.attn_processors.values():
             if isinstance(attn_processor, RefSAttnProcessor2_0):
@@ -476,13 +502,9 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
             with torch.no_grad():
                 image_embeds = self.image_encoder(ref_clip_image.to(device, dtype=prompt_embeds.dtype),
                                                   output_hidden_states=True).hidden_states[-2]
-                image_null_embeds = \
-                    self.image_encoder(torch.zeros_like(ref_clip_image).to(device, dtype=prompt_embeds.dtype),
-                                       output_hidden_states=True).hidden_states[-2]
-                cloth_proj_embed = self.ImgProj(image_embeds)
-                cloth_null_embeds = self.ImgProj(image_null_embeds)
+                ref_prompt_embeds = self.ImgProj(image_embeds)
         else:
-            null_prompt_embeds, _ = self.encode_prompt(
+            ref_prompt_embeds, _ = self.encode_prompt(
                 null_prompt,
                 device,
                 num_images_per_prompt,
@@ -499,10 +521,6 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         # to avoid doing two forward passes
         if do_classifier_free_guidance:
             prompt_embeds_control = torch.cat([negative_prompt_embeds, prompt_embeds])
-            if ref_clip_image is not None:
-                null_prompt_embeds = torch.cat([cloth_null_embeds, cloth_proj_embed])
-            else:
-                null_prompt_embeds = torch.cat([negative_prompt_embeds, null_prompt_embeds])
             prompt_embeds = prompt_embeds
             negative_prompt_embeds = negative_prompt_embeds
 
@@ -542,21 +560,11 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
             for i, t in enumerate(timesteps):
                 # 1. Forward reference image
                 if i == 0:
-                    _ = self.reference_unet(
-                        ref_image_latents.repeat(
-                            (2 if do_classifier_free_guidance else 1), 1, 1, 1
-                        ),
-                        torch.zeros_like(t),
-                        encoder_hidden_states=null_prompt_embeds,
-                        return_dict=False,
+                    sa_hidden_states = self.extract_reference_hidden_states(
+                        ref_image_latents, ref_prompt_embeds, torch.zeros_like(t)
                     )
-
-                    # get cache tensors
-                    sa_hidden_states = {}
-                    for name in self.reference_unet.attn_processors.keys():
-                        sa_hidden_states[name] = self.reference_unet.attn_processors[name].cache["hidden_states"][
-                            1].unsqueeze(0)
-                        # sa_hidden_states[name][0, :, :] = 0
+                    # the reference K/V are projected once instead of at every step
+                    ref_key_values = self.prepare_ref_key_values(sa_hidden_states)
 
                 # 3.1 expand the latents if we are doing classifier free guidance
                 latent_model_input = (
@@ -618,6 +626,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                         encoder_hidden_states=prompt_embeds,
                         cross_attention_kwargs={
                             "sa_hidden_states": sa_hidden_states,
+                            "ref_key_values": ref_key_values,
                         },
                         timestep_cond=timestep_cond,
                         down_block_additional_residuals=down_block_res_samples_con,
@@ -644,6 +653,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                         encoder_hidden_states=prompt_embeds,
                         cross_attention_kwargs={
                             "sa_hidden_states": sa_hidden_states,
+                            "ref_key_values": ref_key_values,
                         },
                         timestep_cond=timestep_cond,
                         added_cond_kwargs=None,
@@ -7,7 +7,7 @@ from diffusers.schedulers import (
     LMSDiscreteScheduler,
     PNDMScheduler,
 )
-from adapter.attention_processor import RefSAttnProcessor2_0
+from adapter.attention_processor import RefSAttnProcessor2_0, prepare_ref_key_value
 
 # 입력 이미지 변형에 초점
 # 이미지의 의상이나 스타일을 변형하는데 초점
@@ -78,6 +78,32 @@ class IMAGDressing_v1(StableDiffusionControlNetInpaintPipeline):
                 return torch.device(module._hf_hook.execution_device)
         return self.device
     
+    # reference UNet 은 실제로 사용되는 조건부 배치만 계산, 각 self-attention 층의 hidden states 반환
+    def extract_reference_hidden_states(self, ref_image_latents, ref_prompt_embeds, timestep):
+        _ = self.reference_unet(
+            ref_image_latents,
+            timestep,
+            encoder_hidden_states=ref_prompt_embeds,
+            return_dict=False,
+        )
+
+        # get cache tensors, popped so the processors do not keep them alive
+        sa_hidden_states = {}
+        for name, attn_processor in self.reference_unet.attn_processors.items():
+            sa_hidden_states[name] = attn_processor.cache.pop("hidden_states")
+        return sa_hidden_states
+
+    # denoising UNet 의 reference K/V projection 을 한 번만 계산 (모든 step 에서 재사용)
+    def prepare_ref_key_values(self, sa_hidden_states):
+        ref_key_values = {}
+        for module in self.unet.modules():
+            attn_processor = getattr(module, "processor", None)
+            if hasattr(attn_processor, "to_k_ref") and attn_processor.name in sa_hidden_states:
+                ref_key_values[attn_processor.name] = prepare_ref_key_value(
+                    attn_processor, module, sa_hidden_states[attn_processor.name]
+                )
+        return ref_key_values
+
     # 모델의 실행 장치를 자동으로 결정
     def set_scale(self, scale):
         for attn_processor in self.unet.attn_processors.values():
@@ -239,13 +265,9 @@ class IMAGDressing_v1(StableDiffusionControlNetInpaintPipeline):
             with torch.no_grad():
                 image_embeds = self.image_encoder(ref_clip_image.to(device, dtype=prompt_embeds.dtype),
                                                   output_hidden_states=True).hidden_states[-2]
-                image_null_embeds = \
-                    self.image_encoder(torch.zeros_like(ref_clip_image).to(device, dtype=prompt_embeds.dtype),
-                                       output_hidden_states=True).hidden_states[-2]
-                cloth_proj_embed = self.ImgProj(image_embeds)
-                cloth_null_embeds = self.ImgProj(image_null_embeds)
+                ref_prompt_embeds = self.ImgProj(image_embeds)
         else:
-            null_prompt_embeds, _ = self.encode_prompt(
+            ref_prompt_embeds, _ = self.encode_prompt(
                 null_prompt,
                 device,
                 num_images_per_prompt,
@@ -261,10 +283,6 @@ class IMAGDressing_v1(StableDiffusionControlNetInpaintPipeline):
         # to avoid doing two forward passes
         if self.do_classifier_free_guidance:
             prompt_embeds_control = torch.cat([negative_prompt_embeds, prompt_embeds])
-            if ref_clip_image is not None:
-                null_prompt_embeds = torch.cat([cloth_null_embeds, cloth_proj_embed])
-            else:
-                null_prompt_embeds = torch.cat([negative_prompt_embeds, null_prompt_embeds])
             # prompt_embeds = prompt_embeds
             # negative_prompt_embeds = negative_prompt_embeds
 
@@ -398,20 +416,11 @@ class IMAGDressing_v1(StableDiffusionControlNetInpaintPipeline):
                 latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
                 if i == 0:
-                    _ = self.reference_unet(
-                        ref_image_latents.repeat(
-                            (2 if self.do_classifier_free_guidance else 1), 1, 1, 1
-                        ),
-                        torch.zeros_like(t),
-                        encoder_hidden_states=null_prompt_embeds,
-                        return_dict=False,
+                    sa_hidden_states = self.extract_reference_hidden_states(
+                        ref_image_latents, ref_prompt_embeds, torch.zeros_like(t)
                     )
-
-                    # get cache tensors
-                    sa_hidden_states = {}
-                    for name in self.reference_unet.attn_processors.keys():
-                        sa_hidden_states[name] = self.reference_unet.attn_processors[name].cache["hidden_states"][
-                            1].unsqueeze(0)
+                    # the reference K/V are projected once instead of at every step
+                    ref_key_values = self.prepare_ref_key_values(sa_hidden_states)
 
                 # controlnet(s) inference
                 if guess_mode and self.do_classifier_free_guidance:
@@ -464,6 +473,7 @@ class IMAGDressing_v1(StableDiffusionControlNetInpaintPipeline):
                         encoder_hidden_states=prompt_embeds,
                         cross_attention_kwargs={
                             "sa_hidden_states": sa_hidden_states,
+                            "ref_key_values": ref_key_values,
                         },
                         down_block_additional_residuals=down_block_res_samples_con,
                         mid_block_additional_residual=mid_block_res_sample[1],
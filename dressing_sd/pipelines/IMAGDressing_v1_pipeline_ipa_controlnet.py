@@ -11,12 +11,15 @@ from diffusers.pipelines.controlnet.pipeline_controlnet import *
 
 import os
 import sys
+from collections import OrderedDict
 from safetensors import safe_open
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 
 from adapter.resampler import ProjPlusModel
+from dressing_sd.pipelines.garment_cache import GarmentFeatureCache
 from adapter.attention_processor import RefSAttnProcessor2_0, LoraRefSAttnProcessor2_0,  IPAttnProcessor2_0, LoRAIPAttnProcessor2_0 
+from adapter.attention_processor import prepare_ref_key_value
 
 
 class IMAGDressing_v1(StableDiffusionControlNetPipeline):
@@ -73,8 +76,13 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         self.ip_ckpt = ip_ckpt
         self.num_tokens = 4
         # image proj model
+        # constant null face conditioning and an LRU of recent prompts / negative prompts
+        self.null_cond_cache = {}
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_size = 64
         self.image_proj_model = self.init_proj()
         self.load_ip_adapter()
+        self.garment_cache = None
 
     # 프로젝션 모델 초기화, 디바이스(하드웨어)에 맞게 준비
     def init_proj(self):
@@ -100,6 +108,11 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         self.image_proj_model.load_state_dict(state_dict["image_proj"])
         ip_layers = torch.nn.ModuleList(self.unet.attn_processors.values())
         ip_layers.load_state_dict(state_dict["ip_adapter"], strict=False)
+        self.clear_conditioning_cache()
+
+    def clear_conditioning_cache(self):
+        self.null_cond_cache.clear()
+        self.prompt_cache.clear()
 
     @property
     def cross_attention_kwargs(self):
@@ -112,6 +125,33 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
     def disable_vae_slicing(self):
         self.vae.disable_slicing()
 
+    # 같은 의상의 VAE latent, CLIP 임베딩, reference UNet hidden states 재사용
+    def enable_garment_cache(self, garment_cache=None, **kwargs):
+        self.garment_cache = garment_cache if garment_cache is not None else GarmentFeatureCache(**kwargs)
+        return self.garment_cache
+
+    def disable_garment_cache(self):
+        self.garment_cache = None
+
+    # LoRA 를 합친 fused projection 사용 (inference 전용, lora_scale 이 바뀌면 다시 합침)
+    def fuse_attn_projections(self):
+        for attn_processor in self.unet.attn_processors.values():
+            if hasattr(attn_processor, "enable_fused_projections"):
+                attn_processor.enable_fused_projections()
+
+    def unfuse_attn_projections(self):
+        for attn_processor in self.unet.attn_processors.values():
+            if hasattr(attn_processor, "disable_fused_projections"):
+                attn_processor.disable_fused_projections()
+
+    # self / reference attention 결합 방식 설정 ("sum" 이 원래 동작, "concat" 근사)
+    def set_ref_attn_mode(self, mode):
+        if mode not in ("sum", "concat"):
+            raise ValueError(f"`mode` has to be either 'sum' or 'concat' but is {mode}")
+        for attn_processor in self.unet.attn_processors.values():
+            if hasattr(attn_processor, "ref_attn_mode"):
+                attn_processor.ref_attn_mode = mode
+
     # GPU -> CPU 오프로드
     def enable_sequential_cpu_offload(self, gpu_id=0):
         if is_accelerate_available():
@@ -314,6 +354,20 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
 
         return prompt_embeds, negative_prompt_embeds
 
+    # 텍스트 임베딩 캐시: prompt / negative prompt 모두 크기 제한이 있는 LRU 로 보관
+    def get_cached_prompt_embeds(self, prompt, device):
+        key = (prompt, str(device))
+        cache = self.prompt_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        prompt_embeds, _ = self.encode_prompt(prompt, device, 1, False)
+        cache[key] = prompt_embeds
+        while len(cache) > self.prompt_cache_size:
+            cache.popitem(last=False)
+        return prompt_embeds
+
     # 주어진 크기, 차원에 맞춰 랜덤 노이즈 생성, 초기 노이즈-> 표준 편차로 조정
     def prepare_latents(
             self,
@@ -376,15 +430,128 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         with torch.no_grad():
             clip_image_embeds = self.image_encoder(clip_image.to(self.device, dtype=torch.float16),
                                                    output_hidden_states=True).hidden_states[-2]
-            uncond_clip_image_embeds = self.image_encoder(
-                torch.zeros_like(clip_image).to(self.device, dtype=torch.float16), output_hidden_states=True
-            ).hidden_states[-2]
 
             faceid_embeds = faceid_embeds.to(self.device, dtype=torch.float16)
             image_prompt_embeds = self.image_proj_model(faceid_embeds, clip_image_embeds)
-            uncond_image_prompt_embeds = self.image_proj_model(torch.zeros_like(faceid_embeds),uncond_clip_image_embeds)
+
+            # the all-zeros face condition only depends on the input shapes and dtypes, encode it once
+            proj_dtype = next(self.image_proj_model.parameters()).dtype
+            key = ("face_null", tuple(clip_image.shape), clip_image.dtype, tuple(faceid_embeds.shape),
+                   faceid_embeds.dtype, self.image_encoder.dtype, proj_dtype, str(self.device))
+            if key not in self.null_cond_cache:
+                uncond_clip_image_embeds = self.image_encoder(
+                    torch.zeros_like(clip_image).to(self.device, dtype=torch.float16), output_hidden_states=True
+                ).hidden_states[-2]
+                self.null_cond_cache[key] = self.image_proj_model(torch.zeros_like(faceid_embeds),
+                                                                  uncond_clip_image_embeds)
+            uncond_image_prompt_embeds = self.null_cond_cache[key]
         return image_prompt_embeds, uncond_image_prompt_embeds
 
+    # reference UNet 은 실제로 사용되는 조건부 배치만 계산, 각 self-attention 층의 hidden states 반환
+    def extract_reference_hidden_states(self, ref_image_latents, ref_prompt_embeds, timestep):
+        _ = self.reference_unet(
+            ref_image_latents,
+            timestep,
+            encoder_hidden_states=ref_prompt_embeds,
+            return_dict=False,
+        )
+
+        # get cache tensors, popped so the processors do not keep them alive
+        sa_hidden_states = {}
+        for name, attn_processor in self.reference_unet.attn_processors.items():
+            sa_hidden_states[name] = attn_processor.cache.pop("hidden_states")
+        return sa_hidden_states
+
+    # denoising UNet 의 reference K/V projection 을 한 번만 계산 (모든 step 에서 재사용)
+    def prepare_ref_key_values(self, sa_hidden_states):
+        ref_key_values = {}
+        for module in self.unet.modules():
+            attn_processor = getattr(module, "processor", None)
+            if hasattr(attn_processor, "to_k_ref") and attn_processor.name in sa_hidden_states:
+                ref_key_values[attn_processor.name] = prepare_ref_key_value(
+                    attn_processor, module, sa_hidden_states[attn_processor.name]
+                )
+        return ref_key_values
+
+    # 의상 reference feature 준비: 캐시에 없는 샘플만 모아 VAE / CLIP / reference UNet 을 한 번에 실행
+    def prepare_garment_features(self, ref_image, ref_clip_image, ref_text_embeds, device, timestep,
+                                 garment_cache_key=None):
+        batch_size = ref_image.shape[0]
+        if not isinstance(garment_cache_key, (list, tuple)):
+            garment_cache_key = [garment_cache_key] * batch_size
+        keys = list(garment_cache_key)
+        features = [None] * batch_size
+
+        # garment features are looked up by content, one entry per garment
+        if self.garment_cache is not None:
+            for i in range(batch_size):
+                if keys[i] is None:
+                    keys[i] = self.garment_cache.hash_image(
+                        ref_image[i:i + 1],
+                        ref_clip_image[i:i + 1] if ref_clip_image is not None else ref_text_embeds[i:i + 1],
+                    )
+                features[i] = self.garment_cache.get(keys[i], device)
+
+        missing = [i for i in range(batch_size) if features[i] is None]
+        if missing:
+            # Prepare ref image latents
+            ref_image_tensor = ref_image[missing].to(
+                dtype=self.vae.dtype, device=self.vae.device
+            )
+            ref_image_latents = self.vae.encode(ref_image_tensor).latent_dist.mean
+            ref_image_latents = ref_image_latents * 0.18215  # (b, 4, h, w)
+
+            if ref_clip_image is not None:
+                image_embeds = self.image_encoder(ref_clip_image[missing].to(device, dtype=ref_text_embeds.dtype),
+                                                  output_hidden_states=True).hidden_states[-2]
+                ref_prompt_embeds = self.ImgProj(image_embeds)
+            else:
+                ref_prompt_embeds = ref_text_embeds[missing]
+
+            # Forward reference image, only the conditional slice is ever consumed
+            sa_hidden_states = self.extract_reference_hidden_states(ref_image_latents, ref_prompt_embeds, timestep)
+            ref_key_values = self.prepare_ref_key_values(sa_hidden_states)
+            # only self-attention processors read the reference, and those with projected K/V never need the raw
+            # hidden states again: keep just the rest, about a quarter of the memory per garment
+            sa_hidden_states = {
+                name: h for name, h in sa_hidden_states.items()
+                if name.endswith("attn1.processor") and name not in ref_key_values
+            }
+
+            def take(tensor, j):
+                # cached entries must not keep the whole batch alive
+                if len(missing) == 1 or self.garment_cache is None:
+                    return tensor[j:j + 1]
+                return tensor[j:j + 1].clone()
+
+            for j, i in enumerate(missing):
+                features[i] = {
+                    "ref_image_latents": take(ref_image_latents, j),
+                    "cloth_proj_embed": take(ref_prompt_embeds, j) if ref_clip_image is not None else None,
+                    "sa_hidden_states": {name: take(h, j) for name, h in sa_hidden_states.items()},
+                    "ref_key_values": {
+                        name: (take(key, j), take(value, j)) for name, (key, value) in ref_key_values.items()
+                    },
+                }
+                if self.garment_cache is not None:
+                    self.garment_cache.put(keys[i], features[i])
+
+        if batch_size == 1:
+            return features[0]
+        return {
+            "ref_image_latents": torch.cat([f["ref_image_latents"] for f in features]),
+            "cloth_proj_embed": torch.cat([f["cloth_proj_embed"] for f in features])
+            if ref_clip_image is not None else None,
+            "sa_hidden_states": {
+                name: torch.cat([f["sa_hidden_states"][name] for f in features])
+                for name in features[0]["sa_hidden_states"]
+            },
+            "ref_key_values": {
+                name: tuple(torch.cat([f["ref_key_values"][name][k] for f in features]) for k in range(2))
+                for name in features[0]["ref_key_values"]
+            },
+        }
+
     def set_scale(self, scale, lora_scale):
         for attn_processor in self.unet.attn_processors.values():
             if isinstance(attn_processor, LoraRefSAttnProcessor2_0):
@@ -438,6 +605,8 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
             guess_mode: bool = False,
             control_guidance_start: Union[float, List[float]] = 0.0,
             control_guidance_end: Union[float, List[float]] = 1.0,
+            batch_cfg: Optional[bool] = None,
+            garment_cache_key: Optional[Union[str, List[str]]] = None,
             **kwargs,
     ):
         
@@ -477,13 +646,25 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         device = self._execution_device
         self._cross_attention_kwargs = cross_attention_kwargs
         self._clip_skip = clip_skip
-        do_classifier_free_guidance = guidance_scale > 1.0
+        if isinstance(guidance_scale, (list, tuple)):
+            # per-sample guidance for micro-batched requests
+            do_classifier_free_guidance = max(guidance_scale) > 1.0
+            guidance_scale = torch.tensor(guidance_scale, device=device, dtype=self.unet.dtype).view(-1, 1, 1, 1)
+        else:
+            do_classifier_free_guidance = guidance_scale > 1.0
 
         # Prepare timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
         timesteps = self.scheduler.timesteps
 
-        batch_size = 1
+        # a list prompt carries one try-on per entry, batched samples always use the fused CFG path
+        batch_size = len(prompt) if isinstance(prompt, list) else 1
+        if batch_size > 1:
+            batch_cfg = True
+        elif batch_cfg is None:
+            # fused CFG whenever guidance is on, batch_cfg=False keeps the two separate UNet calls
+            batch_cfg = do_classifier_free_guidance
+
         if pose_image is not None:
             # Prepare control image
             if isinstance(controlnet, ControlNetModel):
@@ -498,7 +679,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                     do_classifier_free_guidance=do_classifier_free_guidance,
                     guess_mode=guess_mode,
                 )
-                if do_classifier_free_guidance and not guess_mode:
+                if do_classifier_free_guidance and not guess_mode and not batch_cfg:
                     image = image.chunk(2)[0]
                 height, width = image.shape[-2:]
             else:
@@ -509,6 +690,16 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         text_encoder_lora_scale = (
             self.cross_attention_kwargs.get("scale", None) if self.cross_attention_kwargs is not None else None
         )
+        # plain string prompts without text-encoder LoRA / clip skip come from the conditioning cache
+        if text_encoder_lora_scale is None and self.clip_skip is None:
+            if prompt_embeds is None and isinstance(prompt, str):
+                prompt_embeds = self.get_cached_prompt_embeds(prompt, device)
+            elif prompt_embeds is None and isinstance(prompt, list):
+                prompt_embeds = torch.cat([self.get_cached_prompt_embeds(p, device) for p in prompt])
+            if do_classifier_free_guidance and negative_prompt_embeds is None and isinstance(negative_prompt, str):
+                # caller supplied, so it shares the bounded LRU with the prompts
+                negative_prompt_embeds = self.get_cached_prompt_embeds(negative_prompt, device)
+                negative_prompt_embeds = negative_prompt_embeds.repeat(batch_size, 1, 1)
         prompt_embeds, negative_prompt_embeds = self.encode_prompt(
             prompt,
             device,
@@ -531,38 +722,23 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
             uncond_image_prompt_embeds = uncond_image_prompt_embeds.repeat(1, num_samples, 1)
             uncond_image_prompt_embeds = uncond_image_prompt_embeds.view(bs_embed * num_samples, seq_len, -1)
 
-        if ref_clip_image is not None:
-            with torch.no_grad():
-                image_embeds = self.image_encoder(ref_clip_image.to(device, dtype=prompt_embeds.dtype),
-                                                  output_hidden_states=True).hidden_states[-2]
-                image_null_embeds = \
-                    self.image_encoder(torch.zeros_like(ref_clip_image).to(device, dtype=prompt_embeds.dtype),
-                                       output_hidden_states=True).hidden_states[-2]
-                cloth_proj_embed = self.ImgProj(image_embeds)
-                cloth_null_embeds = self.ImgProj(image_null_embeds)
-                # cloth_null_embeds = self.ImgProj(torch.zeros_like(image_embeds))
-        else:
-            null_prompt_embeds, _ = self.encode_prompt(
-                null_prompt,
-                device,
-                num_images_per_prompt,
-                do_classifier_free_guidance,
-                negative_prompt,
-                prompt_embeds=prompt_embeds,
-                negative_prompt_embeds=negative_prompt_embeds,
-                lora_scale=text_encoder_lora_scale,
-                clip_skip=self.clip_skip,
-            )
+        # garment reference features (reference UNet self-attention hidden states), served from the cache if enabled
+        garment_features = self.prepare_garment_features(
+            ref_image,
+            ref_clip_image,
+            prompt_embeds,
+            device,
+            torch.zeros_like(timesteps[0]),
+            garment_cache_key=garment_cache_key,
+        )
+        sa_hidden_states = garment_features["sa_hidden_states"]
+        ref_key_values = garment_features["ref_key_values"]
 
         # For classifier free guidance, we need to do two forward passes.
         # Here we concatenate the unconditional and text embeddings into a single batch
         # to avoid doing two forward passes
         if do_classifier_free_guidance:
             prompt_embeds_control = torch.cat([negative_prompt_embeds, prompt_embeds])
-            if ref_clip_image is not None:
-                null_prompt_embeds = torch.cat([cloth_null_embeds, cloth_proj_embed])
-            else:
-                null_prompt_embeds = torch.cat([negative_prompt_embeds, null_prompt_embeds])
             if face_clip_image is not None:
                 prompt_embeds = torch.cat([prompt_embeds, image_prompt_embeds], dim=1)
                 negative_prompt_embeds = torch.cat([negative_prompt_embeds, uncond_image_prompt_embeds], dim=1)
@@ -584,12 +760,6 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         # Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
-        # Prepare ref image latents
-        ref_image_tensor = ref_image.to(
-            dtype=self.vae.dtype, device=self.vae.device
-        )
-        ref_image_latents = self.vae.encode(ref_image_tensor).latent_dist.mean
-        ref_image_latents = ref_image_latents * 0.18215  # (b, 4, h, w)
         if pose_image is not None:
             #  Create tensor stating which controlnets to keep
             controlnet_keep = []
@@ -604,24 +774,6 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
-                # 1. Forward reference image
-                if i == 0:
-                    _ = self.reference_unet(
-                        ref_image_latents.repeat(
-                            (2 if do_classifier_free_guidance else 1), 1, 1, 1
-                        ),
-                        torch.zeros_like(t),
-                        encoder_hidden_states=null_prompt_embeds,
-                        return_dict=False,
-                    )
-
-                    # get cache tensors
-                    sa_hidden_states = {}
-                    for name in self.reference_unet.attn_processors.keys():
-                        sa_hidden_states[name] = self.reference_unet.attn_processors[name].cache["hidden_states"][
-                            1].unsqueeze(0)
-                        # sa_hidden_states[name][0, :, :] = 0
-
                 # 3.1 expand the latents if we are doing classifier free guidance
                 latent_model_input = (
                     torch.cat([latents] * 2) if do_classifier_free_guidance else latents
@@ -642,7 +794,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                 # for control
                 if pose_image is not None:
                     # controlnet(s) inference
-                    if guess_mode and self.do_classifier_free_guidance:
+                    if guess_mode and do_classifier_free_guidance:
                         # Infer ControlNet only for the conditional batch.
                         control_model_input = latents
                         control_model_input = self.scheduler.scale_model_input(control_model_input, t)
@@ -669,6 +821,34 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                         return_dict=False,
                     )
 
+                # fused CFG: uncond / cond halves share one UNet call, ref features only on the cond half
+                if batch_cfg and do_classifier_free_guidance:
+                    unet_kwargs = {}
+                    if pose_image is not None:
+                        if guess_mode:
+                            # ControlNet was inferred only for the conditional batch, pad the unconditional half
+                            down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in
+                                                      down_block_res_samples]
+                            mid_block_res_sample = torch.cat(
+                                [torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
+                        unet_kwargs["down_block_additional_residuals"] = down_block_res_samples
+                        unet_kwargs["mid_block_additional_residual"] = mid_block_res_sample
+                    noise_pred_uncond, noise_pred_text = self.unet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=torch.cat([negative_prompt_embeds, prompt_embeds]),
+                        cross_attention_kwargs={
+                            "sa_hidden_states": sa_hidden_states,
+                            "ref_batch_slice": slice(latents.shape[0], None),
+                            "ref_key_values": ref_key_values,
+                        },
+                        timestep_cond=timestep_cond,
+                        added_cond_kwargs=None,
+                        return_dict=False,
+                        **unet_kwargs,
+                    )[0].chunk(2)
+                    unc_noise_pred, noise_pred = noise_pred_uncond, noise_pred_text
+                elif pose_image is not None:
                     # if do_classifier_free_guidance:
                     down_block_res_samples_con = []
                     down_block_res_samples_uncon = []
@@ -682,6 +862,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                         encoder_hidden_states=prompt_embeds,
                         cross_attention_kwargs={
                             "sa_hidden_states": sa_hidden_states,
+                            "ref_key_values": ref_key_values,
                         },
                         timestep_cond=timestep_cond,
                         down_block_additional_residuals=down_block_res_samples_con,
@@ -708,6 +889,7 @@ class IMAGDressing_v1(StableDiffusionControlNetPipeline):
                         encoder_hidden_states=prompt_embeds,
                         cross_attention_kwargs={
                             "sa_hidden_states": sa_hidden_states,
+                            "ref_key_values": ref_key_values,
                         },
                         timestep_cond=timestep_cond,
                         added_cond_kwargs=None,
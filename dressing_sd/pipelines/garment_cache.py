@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def _to_device(features, device, non_blocking=False):
+    if isinstance(features, dict):
+        return {k: _to_device(v, device, non_blocking) for k, v in features.items()}
+    if isinstance(features, tuple):
+        return tuple(_to_device(v, device, non_blocking) for v in features)
+    if isinstance(features, torch.Tensor):
+        return features.to(device, non_blocking=non_blocking)
+    return features
+
+
+# 의상 이미지 해시 기반 reference feature 캐시 (GPU LRU -> host RAM -> disk 순으로 밀려남)
+class GarmentFeatureCache:
+    r"""
+    Content-addressed cache for the garment side of IMAGDressing_v1: the reference UNet self-attention
+    hidden states and their projected reference keys / values, the projected CLIP embedding and the VAE latent
+    of the garment image.
+
+    Args:
+        max_gpu_items (`int`, defaults to 32):
+            Number of garments kept on the execution device.
+        max_cpu_items (`int`, defaults to 512):
+            Number of garments kept in host memory after being evicted from the device.
+        disk_dir (`str`, *optional*):
+            Directory garments evicted from host memory are written to. Nothing is spilled if not set.
+    """
+
+    def __init__(self, max_gpu_items=32, max_cpu_items=512, disk_dir=None):
+        self.max_gpu_items = max_gpu_items
+        self.max_cpu_items = max_cpu_items
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._gpu = OrderedDict()
+        self._cpu = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_image(*images, extra=None):
+        h = hashlib.sha1()
+        for image in images:
+            if image is None:
+                continue
+            image = image.detach().cpu().contiguous()
+            h.update(str((tuple(image.shape), str(image.dtype))).encode())
+            h.update(image.numpy().tobytes())
+        if extra is not None:
+            h.update(str(extra).encode())
+        return h.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pt")
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._gpu or key in self._cpu:
+                return True
+        return self.disk_dir is not None and os.path.exists(self._disk_path(key))
+
+    def __len__(self):
+        return len(self._gpu) + len(self._cpu)
+
+    def get(self, key, device):
+        with self._lock:
+            if key in self._gpu:
+                self._gpu.move_to_end(key)
+                return self._gpu[key]
+            features = self._cpu.pop(key, None)
+        if features is None:
+            if self.disk_dir is None or not os.path.exists(self._disk_path(key)):
+                return None
+            features = torch.load(self._disk_path(key), map_location="cpu")
+
+        features = _to_device(features, device)
+        self.put(key, features)
+        return features
+
+    def put(self, key, features):
+        with self._lock:
+            self._gpu[key] = features
+            self._gpu.move_to_end(key)
+            while len(self._gpu) > self.max_gpu_items:
+                old_key, old_features = self._gpu.popitem(last=False)
+                self._cpu[old_key] = _to_device(old_features, "cpu")
+            spilled = []
+            while len(self._cpu) > self.max_cpu_items:
+                spilled.append(self._cpu.popitem(last=False))
+
+        if self.disk_dir is not None:
+            for old_key, old_features in spilled:
+                if not os.path.exists(self._disk_path(old_key)):
+                    torch.save(old_features, self._disk_path(old_key))
+
+    def clear(self):
+        with self._lock:
+            self._gpu.clear()
+            self._cpu.clear()
@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+# 샘플마다 다른 값을 가지며 배치 차원으로 합쳐지는 인자들
+_STACKED_ARGS = ("ref_image", "ref_clip_image", "face_clip_image", "faceid_embeds")
+_LISTED_ARGS = ("prompt", "pose_image", "generator", "guidance_scale", "garment_cache_key")
+
+
+class _Request:
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.future = Future()
+        self.arrival = time.monotonic()
+
+
+# 동시에 들어온 try-on 요청을 모아 IMAGDressing_v1 의 한 번의 배치 디노이징 루프로 실행
+class TryOnBatcher:
+    r"""
+    Request queue and dynamic batcher in front of `IMAGDressing_v1`.
+
+    Requests that share resolution, step count, attention scales, whether classifier-free guidance is on and the
+    kind of conditioning (face / pose) are grouped into one call with per-sample garments, faces, poses, guidance
+    scales and generators.
+
+    Args:
+        pipe (`IMAGDressing_v1`):
+            The long-lived pipeline every batch is run on.
+        max_batch_size (`int`, defaults to 4):
+            Maximum number of try-ons denoised together.
+        max_wait (`float`, defaults to 0.05):
+            Seconds the oldest queued request may wait for companions before its batch is started.
+    """
+
+    def __init__(self, pipe, max_batch_size=4, max_wait=0.05):
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        self._pending = deque()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _batch_key(kwargs):
+        return (
+            kwargs.get("width"),
+            kwargs.get("height"),
+            kwargs.get("num_inference_steps"),
+            kwargs.get("image_scale", 1.0),
+            kwargs.get("ipa_scale", 0.0),
+            kwargs.get("s_lora_scale", 0.0),
+            kwargs.get("c_lora_scale", 0.0),
+            kwargs.get("null_prompt"),
+            kwargs.get("negative_prompt"),
+            # a batch runs the unconditional pass once any sample has guidance_scale > 1
+            (kwargs.get("guidance_scale") or 0.0) > 1.0,
+            kwargs.get("face_clip_image") is None,
+            kwargs.get("pose_image") is None,
+            kwargs.get("ref_clip_image") is None,
+        )
+
+    def submit(self, **kwargs):
+        request = _Request(kwargs)
+        self._queue.put(request)
+        return request.future
+
+    def __call__(self, **kwargs):
+        return self.submit(**kwargs).result()
+
+    def _collect(self):
+        first = self._pending.popleft() if self._pending else self._queue.get()
+        key = self._batch_key(first.kwargs)
+        batch = [first]
+
+        for request in list(self._pending):
+            if len(batch) >= self.max_batch_size:
+                break
+            if self._batch_key(request.kwargs) == key:
+                self._pending.remove(request)
+                batch.append(request)
+
+        # wait for companions until the oldest request's latency budget is spent
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if self._batch_key(request.kwargs) == key:
+                batch.append(request)
+            else:
+                self._pending.append(request)
+        return batch
+
+    @staticmethod
+    def _random_generator(device):
+        # seeded from OS entropy, leaves the global torch RNG untouched
+        generator = torch.Generator(device)
+        generator.seed()
+        return generator
+
+    def _merge(self, batch):
+        kwargs = dict(batch[0].kwargs)
+        kwargs["num_images_per_prompt"] = 1
+        for name in _STACKED_ARGS:
+            if kwargs.get(name) is not None:
+                kwargs[name] = torch.cat([request.kwargs[name] for request in batch])
+        for name in _LISTED_ARGS:
+            kwargs[name] = [request.kwargs.get(name) for request in batch]
+
+        if all(key is None for key in kwargs["garment_cache_key"]):
+            kwargs["garment_cache_key"] = None
+        if kwargs["pose_image"][0] is None:
+            kwargs["pose_image"] = None
+        # randn_tensor needs a generator per sample once any sample has one
+        if any(generator is not None for generator in kwargs["generator"]):
+            device = self.pipe._execution_device
+            kwargs["generator"] = [
+                generator if generator is not None else self._random_generator(device)
+                for generator in kwargs["generator"]
+            ]
+        else:
+            kwargs["generator"] = None
+        return kwargs
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            try:
+                images = self.pipe(**self._merge(batch)).images
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, image in zip(batch, images):
+                request.future.set_result(image)
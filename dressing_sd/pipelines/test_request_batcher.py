@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import torch
+
+from dressing_sd.pipelines.request_batcher import TryOnBatcher
+
+
+# IMAGDressing_v1 의 CFG 결합만 흉내내는 pipeline
+class _GuidancePipe:
+    _execution_device = torch.device("cpu")
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, ref_image, guidance_scale, **kwargs):
+        self.batch_sizes.append(ref_image.shape[0])
+        if isinstance(guidance_scale, (list, tuple)):
+            do_classifier_free_guidance = max(guidance_scale) > 1.0
+            guidance_scale = torch.tensor(guidance_scale).view(-1, 1)
+        else:
+            do_classifier_free_guidance = guidance_scale > 1.0
+        cond, uncond = ref_image, -ref_image
+        if do_classifier_free_guidance:
+            images = uncond + guidance_scale * (cond - uncond)
+        else:
+            images = cond
+        return SimpleNamespace(images=list(images))
+
+
+def _request(value, guidance_scale):
+    return dict(ref_image=torch.full((1, 4), value), prompt="a photography of a model",
+                guidance_scale=guidance_scale, width=512, height=640, num_inference_steps=2)
+
+
+def test_guidance_off_request_is_not_batched_with_cfg_requests():
+    requests = [_request(1.0, 0.5), _request(2.0, 3.0)]
+    expected = [_GuidancePipe()(**request).images[0] for request in requests]
+
+    pipe = _GuidancePipe()
+    batcher = TryOnBatcher(pipe, max_batch_size=4, max_wait=0.5)
+    futures = [batcher.submit(**request) for request in requests]
+    results = [future.result(timeout=10) for future in futures]
+
+    for result, reference in zip(results, expected):
+        assert torch.equal(result, reference)
+    assert sorted(pipe.batch_sizes) == [1, 1]
+
+
+def test_cfg_requests_share_a_batch():
+    requests = [_request(1.0, 2.0), _request(2.0, 3.0)]
+    expected = [_GuidancePipe()(**request).images[0] for request in requests]
+
+    pipe = _GuidancePipe()
+    batcher = TryOnBatcher(pipe, max_batch_size=4, max_wait=0.5)
+    futures = [batcher.submit(**request) for request in requests]
+    results = [future.result(timeout=10) for future in futures]
+
+    for result, reference in zip(results, expected):
+        assert torch.equal(result, reference)
+    assert pipe.batch_sizes == [2]
@@ -0,0 +1,75 @@
+import argparse
+import io
+import json
+import os
+import tarfile
+from multiprocessing import Pool
+
+from PIL import Image
+from torchvision import transforms
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pack the IGPair json + images into tar shards of pre-resized images and captions, "
+                    "read by IGPair.VDShardDataset.")
+    parser.add_argument("--dataset_json_path", type=str, default=None, required=True, help="Path to dataset json file.")
+    parser.add_argument("--output_dir", type=str, default=None, required=True, help="Where the shards are written.")
+    parser.add_argument("--shard_size", type=int, default=1000, help="Samples per shard.")
+    parser.add_argument("--size", type=int, default=512, help="Short side the images are resized to.")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of the stored images.")
+    parser.add_argument("--num_workers", type=int, default=8)
+    return parser.parse_args()
+
+
+def encode_image(path, size, quality):
+    # VDDataset.transform 의 Resize(512) 를 미리 적용해 저장
+    img = Image.open(path).convert("RGB")
+    img = transforms.functional.resize(img, size, interpolation=transforms.InterpolationMode.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shard(job):
+    path, start, items, size, quality = job
+    if os.path.exists(path):
+        return
+    # write to a temporary name so an interrupted run never leaves a truncated shard behind
+    with tarfile.open(path + ".tmp", mode="w") as tar:
+        for i, item in enumerate(items):
+            key = f"{start + i:09d}"
+            add_file(tar, f"{key}.person.jpg", encode_image(item["image_file"], size, quality))
+            add_file(tar, f"{key}.cloth.jpg", encode_image(item["cloth_file"], size, quality))
+            add_file(tar, f"{key}.json", json.dumps({"text": item["text"]}).encode("utf-8"))
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(args.dataset_json_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+
+    shards, jobs = [], []
+    for shard_id, start in enumerate(range(0, len(data), args.shard_size)):
+        items = data[start:start + args.shard_size]
+        shards.append({"file": f"shard_{shard_id:05d}.tar", "num_samples": len(items)})
+        jobs.append((os.path.join(args.output_dir, shards[-1]["file"]), start, items, args.size, args.quality))
+
+    with Pool(args.num_workers) as pool:
+        for i, _ in enumerate(pool.imap_unordered(write_shard, jobs)):
+            print(f"{i + 1}/{len(jobs)} shards")
+
+    with open(os.path.join(args.output_dir, "index.json"), 'w') as file:
+        json.dump({"shards": shards}, file)
+
+
+if __name__ == "__main__":
+    main()
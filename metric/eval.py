@@ -1,5 +1,6 @@
 import cv2
 import numpy as np
+from scipy.spatial import cKDTree
 from skimage.metrics import structural_similarity as ssim
 from skimage.feature import local_binary_pattern
 import os
@@ -30,12 +31,11 @@ def calculate_ssim(img1, img2):
 def calculate_keypoint_matching(keypoints1, keypoints2):
     keypoints1 = np.array(keypoints1)
     keypoints2 = np.array(keypoints2)
-    if len(keypoints2) == 0 or len(keypoints2) > 5000:
+    if len(keypoints2) == 0:
         return 0.99
     else:
-
-        distances_array1 = np.linalg.norm(keypoints1[:, np.newaxis, :] - keypoints2[np.newaxis, :, :], axis=2)
-        min_distances_array1 = np.min(distances_array1, axis=1)
+        # nearest keypoint2 of every keypoint1, O(N log M) without the dense N x M distance matrix
+        min_distances_array1, _ = cKDTree(keypoints2).query(keypoints1, k=1)
 
         return np.mean(min_distances_array1) / (512. * np.sqrt(2))
 
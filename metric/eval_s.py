@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import clip
 from PIL import Image
+from scipy.spatial import cKDTree
 from skimage.metrics import structural_similarity as ssim
 from skimage.feature import local_binary_pattern
 import insightface
@@ -41,12 +42,11 @@ def calculate_ssim(img1, img2):
 def calculate_keypoint_matching(keypoints1, keypoints2):
     keypoints1 = np.array(keypoints1)
     keypoints2 = np.array(keypoints2)
-    if len(keypoints2) == 0 or len(keypoints2) > 5000:
+    if len(keypoints2) == 0:
         return 0.99
     else:
-        distances_array1 = np.linalg.norm(keypoints1[:, np.newaxis, :] - keypoints2[np.newaxis, :, :], axis=2)
-
-        min_distances_array1 = np.min(distances_array1, axis=1)
+        # nearest keypoint2 of every keypoint1, O(N log M) without the dense N x M distance matrix
+        min_distances_array1, _ = cKDTree(keypoints2).query(keypoints1, k=1)
 
         return np.mean(min_distances_array1) / (512. * np.sqrt(2))
 
@@ -153,10 +153,14 @@ if __name__ == '__main__':
                 face_path = faces_list[k_face]
                 face_path1 = os.path.join(args.face_path, face_path)
 
-                for cloth in cloth_paths:
+                # pose maps of all generated images for this prompt / pose / face in one batched detection
+                generates = ['pt_{}_pose_{}_face_{}_{}'.format(i_prompt, j_pose, k_face, cloth)
+                             for cloth in cloth_paths]
+                pose_outputs = model_pose.batch([os.path.join(args.model_path, generate) for generate in generates],
+                                                return_map=True)
+
+                for cloth, generate, (_, pose_image2) in zip(cloth_paths, generates, pose_outputs):
                     cloth = os.path.join(args.cloth_path, cloth)
-                    generate = 'pt_{}_pose_{}_face_{}_{}'.format(i_prompt, j_pose,
-                                                                 k_face, cloth.split("/")[-1])
                     generate_cloth_path = os.path.join(args.cloth_mask_path, generate)
                     reference_cloth_img = cv2.imread(cloth)
                     generate_cloth_img = cv2.imread(generate_cloth_path)
@@ -167,7 +171,6 @@ if __name__ == '__main__':
                     h, w = generate_cloth_img.shape[0], generate_cloth_img.shape[1]
                     reference_cloth_img = cv2.resize(reference_cloth_img, (w, h))
 
-                    _, pose_image2 = model_pose(img_path, )
                     h, w = pose1.shape[0], pose1.shape[1]
                     pose2 = cv2.resize(pose_image2, (w, h))
 
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import torch
+from diffusers import AutoencoderKL
+from PIL import Image
+from safetensors.torch import save_file
+from torchvision import transforms
+from tqdm import tqdm
+from transformers import CLIPImageProcessor, CLIPTextModel, CLIPTokenizer, CLIPVisionModelWithProjection
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Encode the IGPair dataset once into VAE latent distributions, CLIP image features and "
+                    "text embeddings for train.py --feature_dir.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--image_encoder_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--pretrained_vae_model_path",
+        type=str,
+        default=None,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument("--dataset_json_path", type=str, default=None, required=True, help="Path to dataset json file.")
+    parser.add_argument("--output_dir", type=str, default=None, required=True, help="Where the shards are written.")
+    parser.add_argument("--num_crops", type=int, default=4, help="Random crop variants encoded per image.")
+    parser.add_argument("--shard_size", type=int, default=256, help="Samples per shard.")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size of the encoders.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the crop variants.")
+    parser.add_argument("--num_processes", type=int, default=1, help="Split the shards over several processes.")
+    parser.add_argument("--process_index", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cuda")
+    return parser.parse_args()
+
+
+def crop_variants(img, num_crops, rng, height=640, width=512):
+    # VDDataset.transform 과 같은 Resize(512) + RandomCrop([640, 512]) 를 고정된 offset 으로 num_crops 번
+    img = transforms.functional.resize(img, 512, interpolation=transforms.InterpolationMode.BILINEAR)
+    crops = []
+    for _ in range(num_crops):
+        top = rng.randint(0, img.height - height)
+        left = rng.randint(0, img.width - width)
+        crop = transforms.functional.crop(img, top, left, height, width)
+        crops.append(transforms.functional.normalize(transforms.functional.to_tensor(crop), [0.5], [0.5]))
+    return torch.stack(crops)
+
+
+@torch.no_grad()
+def encode_moments(vae, images, batch_size):
+    # latent_dist 의 mean / logvar 를 그대로 저장, 학습 때 sample
+    moments = []
+    for i in range(0, len(images), batch_size):
+        moments.append(vae.encode(images[i:i + batch_size].to(vae.device, dtype=vae.dtype)).latent_dist.parameters)
+    return torch.cat(moments).half().cpu()
+
+
+@torch.no_grad()
+def encode_texts(tokenizer, text_encoder, texts, batch_size):
+    embeds = []
+    for i in range(0, len(texts), batch_size):
+        input_ids = tokenizer(
+            texts[i:i + batch_size],
+            max_length=tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt"
+        ).input_ids
+        embeds.append(text_encoder(input_ids.to(text_encoder.device))[0])
+    return torch.cat(embeds).half().cpu()
+
+
+@torch.no_grad()
+def encode_images(image_encoder, clip_images, batch_size):
+    embeds = []
+    for i in range(0, len(clip_images), batch_size):
+        embeds.append(image_encoder(clip_images[i:i + batch_size].to(image_encoder.device, dtype=image_encoder.dtype),
+                                    output_hidden_states=True).hidden_states[-2])
+    return torch.cat(embeds).half().cpu()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+
+    tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer")
+    text_encoder = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder")
+    vae = AutoencoderKL.from_pretrained(args.pretrained_vae_model_path)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.image_encoder_path)
+    text_encoder.to(args.device, dtype=dtype).eval()
+    vae.to(args.device, dtype=dtype).eval()
+    image_encoder.to(args.device, dtype=dtype).eval()
+    clip_image_processor = CLIPImageProcessor()
+
+    with open(args.dataset_json_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+
+    num_shards = (len(data) + args.shard_size - 1) // args.shard_size
+    shards = [
+        {"file": f"shard_{shard_id:05d}.safetensors",
+         "num_samples": min(args.shard_size, len(data) - shard_id * args.shard_size)}
+        for shard_id in range(num_shards)
+    ]
+
+    if args.process_index == 0:
+        # drop_image_embed / 빈 caption 일 때 쓰는 상수 feature
+        clip_image = clip_image_processor(images=Image.new("RGB", (512, 640)), return_tensors="pt").pixel_values
+        save_file({
+            "image_embeds": encode_images(image_encoder, torch.zeros_like(clip_image), 1),
+            "text_embeds": encode_texts(tokenizer, text_encoder, [""], 1),
+        }, os.path.join(args.output_dir, "null.safetensors"))
+
+    for shard_id in tqdm(range(args.process_index, num_shards, args.num_processes)):
+        path = os.path.join(args.output_dir, shards[shard_id]["file"])
+        if os.path.exists(path):
+            continue
+        items = data[shard_id * args.shard_size:(shard_id + 1) * args.shard_size]
+
+        person_moments, clothes_moments, clip_images = [], [], []
+        captions, caption_offsets = [], [0]
+        for i, item in enumerate(items):
+            # person crop offsets only depend on the seed and the sample index, garment crop offsets on the seed
+            # and the garment, so every pair wearing the same garment gets the same garment crops
+            person_rng = random.Random(args.seed * len(data) + shard_id * args.shard_size + i)
+            clothes_rng = random.Random(f"{args.seed}:{item['cloth_file']}")
+            person_img = Image.open(item["image_file"]).convert("RGB")
+            clothes_img = Image.open(item["cloth_file"]).convert("RGB")
+            person_moments.append(
+                encode_moments(vae, crop_variants(person_img, args.num_crops, person_rng), args.batch_size))
+            clothes_moments.append(
+                encode_moments(vae, crop_variants(clothes_img, args.num_crops, clothes_rng), args.batch_size))
+            clip_images.append(clip_image_processor(images=clothes_img, return_tensors="pt").pixel_values)
+            captions.extend(item["text"])
+            caption_offsets.append(len(captions))
+
+        tensors = {
+            "person_moments": torch.stack(person_moments),
+            "clothes_moments": torch.stack(clothes_moments),
+            "image_embeds": encode_images(image_encoder, torch.cat(clip_images), args.batch_size),
+            "caption_embeds": encode_texts(tokenizer, text_encoder, captions, args.batch_size),
+            "caption_offsets": torch.tensor(caption_offsets, dtype=torch.int64),
+        }
+        # write to a temporary name so an interrupted run never leaves a truncated shard behind
+        save_file(tensors, path + ".tmp", metadata={
+            "captions": json.dumps(captions),
+            "cloth_files": json.dumps([item["cloth_file"] for item in items]),
+        })
+        os.replace(path + ".tmp", path)
+
+    if args.process_index == 0:
+        # the other processes may still be encoding, index.json only appears once every shard is on disk
+        missing = [shard["file"] for shard in shards]
+        while True:
+            missing = [name for name in missing if not os.path.exists(os.path.join(args.output_dir, name))]
+            if not missing:
+                break
+            print(f"waiting for {len(missing)} shards of the other processes")
+            time.sleep(30)
+        with open(os.path.join(args.output_dir, "index.json"), 'w') as file:
+            json.dump({"num_crops": args.num_crops, "null_file": "null.safetensors", "shards": shards}, file)
+
+
+if __name__ == "__main__":
+    main()
@@ -87,3 +87,58 @@ class SimpleFolderDataset(data.Dataset):
         }
 
         return input, meta
+
+
+class MultiSizeFolderDataset(SimpleFolderDataset):
+    """
+    Decodes every image once and warps it to each of `input_sizes` (e.g. ATR 512 and LIP 473).
+    `root` may also be a list of image paths / PIL images. All input sizes must share one aspect ratio.
+    """
+    def __init__(self, root, input_sizes=([512, 512], [473, 473]), transform=None):
+        if isinstance(root, (list, tuple)):
+            self.root = ''
+            self.file_list = list(root)
+            self.transform = transform
+            self.aspect_ratio = input_sizes[0][1] * 1.0 / input_sizes[0][0]
+            self.input_size = np.asarray(input_sizes[0])
+            self.is_pil_image = False
+        else:
+            super(MultiSizeFolderDataset, self).__init__(root, input_size=input_sizes[0], transform=transform)
+        self.input_sizes = [np.asarray(input_size) for input_size in input_sizes]
+
+    def __getitem__(self, index):
+        item = self.file_list[index]
+        if isinstance(item, Image.Image):
+            img = np.asarray(item)[:, :, [2, 1, 0]]
+            name = str(index)
+        else:
+            img_path = os.path.join(self.root, item)
+            img = cv2.imread(img_path, cv2.IMREAD_COLOR)
+            name = item
+        h, w, _ = img.shape
+
+        # Get person center and scale
+        person_center, s = self._box2cs([0, 0, w - 1, h - 1])
+        r = 0
+        inputs = []
+        for input_size in self.input_sizes:
+            trans = get_affine_transform(person_center, s, r, input_size)
+            input = cv2.warpAffine(
+                img,
+                trans,
+                (int(input_size[1]), int(input_size[0])),
+                flags=cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=(0, 0, 0))
+            inputs.append(self.transform(input))
+
+        meta = {
+            'name': name,
+            'center': person_center,
+            'height': h,
+            'width': w,
+            'scale': s,
+            'rotation': r
+        }
+
+        return inputs, meta
@@ -55,6 +55,8 @@ def get_arguments():
     parser.add_argument("--save-results", action="store_true", help="whether to save the results.")
     parser.add_argument("--flip", action="store_true", help="random flip during the test.")
     parser.add_argument("--multi-scales", type=str, default='1', help="multiple scales during the test")
+    parser.add_argument("--logits-dtype", type=str, default='float32', choices=['float32', 'float16'],
+                        help="storage type of the saved logits.")
     return parser.parse_args()
 
 
@@ -202,7 +204,7 @@ def main():
                 # save logits
                 logits_result = transform_logits(logits, c, s, w, h, input_size)
                 logits_result_path = os.path.join(sp_results_dir, im_name + '.npy')
-                np.save(logits_result_path, logits_result)
+                np.save(logits_result_path, logits_result.astype(args.logits_dtype, copy=False))
     return
 
 
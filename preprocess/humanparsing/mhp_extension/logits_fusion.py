@@ -7,72 +7,117 @@ from PIL import Image as PILImage
 import joblib
 
 
-def mask_nms(masks, bbox_scores, instances_confidence_threshold=0.5, overlap_threshold=0.7):
+def mask_bboxes(masks):
+    """
+    Inclusive [y0, x0, y1, x1] box of every instance in `masks` ([h, w, n]), computed in one pass.
+    Empty masks get an empty box.
+    """
+    rows = masks.any(axis=1)
+    cols = masks.any(axis=0)
+    height, width = masks.shape[:2]
+    y0 = np.where(rows.any(axis=0), rows.argmax(axis=0), 0)
+    x0 = np.where(cols.any(axis=0), cols.argmax(axis=0), 0)
+    y1 = np.where(rows.any(axis=0), height - 1 - rows[::-1].argmax(axis=0), -1)
+    x1 = np.where(cols.any(axis=0), width - 1 - cols[::-1].argmax(axis=0), -1)
+    return np.stack([y0, x0, y1, x1], axis=1)
+
+
+def mask_nms(masks, bbox_scores, instances_confidence_threshold=0.5, overlap_threshold=0.7, bboxes=None):
     """
     NMS-like procedure used in Panoptic Segmentation
     Remove the overlap areas of different instances in Instance Segmentation
+    Every instance only touches its own bounding box; `bboxes` ([n, 4] inclusive y0, x0, y1, x1)
+    must enclose the masks and are computed from them when not given.
     """
     panoptic_seg = np.zeros(masks.shape[:2], dtype=np.uint8)
-    sorted_inds = list(range(len(bbox_scores)))
+    occupied = np.zeros(masks.shape[:2], dtype=bool)
     current_segment_id = 0
     segments_score = []
 
-    for inst_id in sorted_inds:
-        score = bbox_scores[inst_id]
-        if score < instances_confidence_threshold:
+    num_instances = len(bbox_scores)
+    for inst_id in range(len(bbox_scores)):
+        if bbox_scores[inst_id] < instances_confidence_threshold:
+            num_instances = inst_id
             break
-        mask = masks[:, :, inst_id]
+    if bboxes is None:
+        bboxes = mask_bboxes(masks[:, :, :num_instances])
+
+    for inst_id in range(num_instances):
+        score = bbox_scores[inst_id]
+        y0, x0, y1, x1 = [int(v) for v in bboxes[inst_id]]
+        if y1 < y0 or x1 < x0:
+            continue
+        window = (slice(y0, y1 + 1), slice(x0, x1 + 1))
+        mask = masks[window + (inst_id,)]
         mask_area = mask.sum()
 
         if mask_area == 0:
             continue
 
-        intersect = (mask > 0) & (panoptic_seg > 0)
+        intersect = (mask > 0) & occupied[window]
         intersect_area = intersect.sum()
 
         if intersect_area * 1.0 / mask_area > overlap_threshold:
             continue
 
         if intersect_area > 0:
-            mask = mask & (panoptic_seg == 0)
+            mask = mask & ~occupied[window]
 
         current_segment_id += 1
-        #         panoptic_seg[np.where(mask==1)] = current_segment_id
-        #         panoptic_seg = panoptic_seg + current_segment_id*mask
-        panoptic_seg = np.where(mask == 0, panoptic_seg, current_segment_id)
+        keep = mask != 0
+        panoptic_seg[window][keep] = current_segment_id
+        occupied[window] |= keep
         segments_score.append(score)
-    #         print(np.unique(panoptic_seg))
     return panoptic_seg, segments_score
 
 
-def extend(si, sj, instance_label, global_label, panoptic_seg_mask, class_map):
+def extend(instance_label, global_label, panoptic_seg_mask, class_map, global_class):
     """
+    Grow every instance part of `global_class` into the 8-connected unlabeled pixels
+    of the same global class. Each unlabeled region goes to the adjacent seed pixel
+    that comes first in raster order, which is the seed the per-pixel BFS reached first.
     """
-    directions = [[-1, 0], [0, 1], [1, 0], [0, -1],
-                  [1, 1], [1, -1], [-1, 1], [-1, -1]]
-
-    inst_class = instance_label[si, sj]
-    human_class = panoptic_seg_mask[si, sj]
-    global_class = class_map[inst_class]
-    queue = [[si, sj]]
-
-    while len(queue) != 0:
-        cur = queue[0]
-        queue.pop(0)
+    height, width = instance_label.shape
+    inst_classes = np.zeros(max(class_map.keys(), default=0) + 1, dtype=np.int64)
+    for label, cls in class_map.items():
+        inst_classes[label] = cls
+
+    unlabeled = (instance_label == 0) & (global_label == global_class)
+    num_regions, regions = cv2.connectedComponents(unlabeled.astype(np.uint8), connectivity=8)
+    if num_regions <= 1:
+        return
+
+    labeled = instance_label != 0
+    seed_inst = np.where(labeled, instance_label, 0)
+    seed_inst[seed_inst >= len(inst_classes)] = 0
+    seeds = labeled & (inst_classes[seed_inst] == global_class)
+    seed_i, seed_j = np.nonzero(seeds)
+    if len(seed_i) == 0:
+        return
+
+    # first seed (raster order) touching each region
+    padded = np.pad(regions, 1)
+    seed_order = seed_i * width + seed_j
+    first_seed = np.full(num_regions, height * width, dtype=np.int64)
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di == 0 and dj == 0:
+                continue
+            np.minimum.at(first_seed, padded[seed_i + 1 + di, seed_j + 1 + dj], seed_order)
+    first_seed[0] = height * width
 
-        for direction in directions:
-            ni = cur[0] + direction[0]
-            nj = cur[1] + direction[1]
+    claimed = first_seed < height * width
+    if not claimed.any():
+        return
+    region_inst = np.zeros(num_regions, dtype=instance_label.dtype)
+    region_human = np.zeros(num_regions, dtype=panoptic_seg_mask.dtype)
+    region_inst[claimed] = instance_label.reshape(-1)[first_seed[claimed]]
+    region_human[claimed] = panoptic_seg_mask.reshape(-1)[first_seed[claimed]]
 
-            if ni >= 0 and nj >= 0 and \
-                    ni < instance_label.shape[0] and \
-                    nj < instance_label.shape[1] and \
-                    instance_label[ni, nj] == 0 and \
-                    global_label[ni, nj] == global_class:
-                instance_label[ni, nj] = inst_class
-                # Using refined instance label to refine human label
-                panoptic_seg_mask[ni, nj] = human_class
-                queue.append([ni, nj])
+    grown = claimed[regions]
+    instance_label[grown] = region_inst[regions[grown]]
+    # Using refined instance label to refine human label
+    panoptic_seg_mask[grown] = region_human[regions[grown]]
 
 
 def refine(instance_label, panoptic_seg_mask, global_label, class_map):
@@ -83,10 +128,9 @@ def refine(instance_label, panoptic_seg_mask, global_label, class_map):
         [ global_label ] with shape [h, w]
             np.array()
   """
-    for i in range(instance_label.shape[0]):
-        for j in range(instance_label.shape[1]):
-            if instance_label[i, j] != 0:
-                extend(i, j, instance_label, global_label, panoptic_seg_mask, class_map)
+    # regions of different global classes never touch each other's pixels
+    for global_class in sorted(set(class_map.values())):
+        extend(instance_label, global_label, panoptic_seg_mask, class_map, global_class)
 
 
 def get_palette(num_cls):
@@ -114,23 +158,28 @@ def get_palette(num_cls):
     return palette
 
 
-def patch2img_output(patch_dir, img_name, img_height, img_width, bbox, bbox_type, num_class):
-    """transform bbox patch outputs to image output"""
+def patch2img_output(patch_dir, img_name, img_height, img_width, bbox, bbox_type, num_class, dtype=np.float32):
+    """transform bbox patch outputs to image output
+    Patches are memory-mapped and accumulated into one preallocated `dtype` buffer,
+    which is averaged in place and returned.
+    """
     assert bbox_type == 'gt' or 'msrcnn'
-    output = np.zeros((img_height, img_width, num_class), dtype='float')
+    output = np.zeros((img_height, img_width, num_class), dtype=dtype)
     output[:, :, 0] = np.inf
-    count_predictions = np.zeros((img_height, img_width, num_class), dtype='int32')
+    # every patch covers all foreground classes, a per-pixel count is enough
+    count_predictions = np.zeros((img_height, img_width), dtype=np.int32)
     for i in range(len(bbox)):  # person index starts from 1
         file_path = os.path.join(patch_dir, os.path.splitext(img_name)[0] + '_' + str(i + 1) + '_' + bbox_type + '.npy')
-        bbox_output = np.load(file_path)
-        output[bbox[i][1]:bbox[i][3] + 1, bbox[i][0]:bbox[i][2] + 1, 1:] += bbox_output[:, :, 1:]
-        count_predictions[bbox[i][1]:bbox[i][3] + 1, bbox[i][0]:bbox[i][2] + 1, 1:] += 1
-        output[bbox[i][1]:bbox[i][3] + 1, bbox[i][0]:bbox[i][2] + 1, 0] \
-            = np.minimum(output[bbox[i][1]:bbox[i][3] + 1, bbox[i][0]:bbox[i][2] + 1, 0], bbox_output[:, :, 0])
+        bbox_output = np.load(file_path, mmap_mode='r')
+        window = (slice(bbox[i][1], bbox[i][3] + 1), slice(bbox[i][0], bbox[i][2] + 1))
+        output[window + (slice(1, None),)] += bbox_output[:, :, 1:]
+        count_predictions[window] += 1
+        np.minimum(output[window + (0,)], bbox_output[:, :, 0], out=output[window + (0,)])
 
     # Caution zero dividing.
     count_predictions[count_predictions == 0] = 1
-    return output / count_predictions
+    output[:, :, 1:] /= count_predictions[:, :, None]
+    return output
 
 
 def get_instance(cat_gt, panoptic_seg_mask):
@@ -261,18 +310,14 @@ def multi_process(a, args):
     bbox_score = a['person_bbox_score']
 
     ######### loading outputs from gloabl and local models #########
-    global_output = np.load(os.path.join(args.global_output_dir, os.path.splitext(img_name)[0] + '.npy'))
-
-    msrcnn_output = patch2img_output(args.msrcnn_output_dir, img_name, img_height, img_width, msrcnn_bbox,
-                                     bbox_type='msrcnn', num_class=20)
-
-    gt_output = patch2img_output(args.gt_output_dir, img_name, img_height, img_width, msrcnn_bbox, bbox_type='msrcnn',
-                                 num_class=20)
+    global_output = np.load(os.path.join(args.global_output_dir, os.path.splitext(img_name)[0] + '.npy'),
+                            mmap_mode='r')
 
     #### global and local branch logits fusion #####
-#     fused_output = global_output + msrcnn_output + gt_output
-    fused_output = global_output + gt_output
-
+    # the local branch buffer is reused for the fused logits, the global logits are streamed from disk
+    fused_output = patch2img_output(args.gt_output_dir, img_name, img_height, img_width, msrcnn_bbox,
+                                    bbox_type='msrcnn', num_class=20)
+    fused_output += global_output
 
     mask_output_path = os.path.join(args.mask_output_dir, os.path.splitext(img_name)[0] + '_mask.npy')
     result_saving(fused_output, img_name, img_height, img_width, args.save_dir, mask_output_path, bbox_score, msrcnn_bbox)
@@ -283,7 +328,7 @@ def main(args):
     json_file = open(args.test_json_path)
     anno = json.load(json_file)['root']
 
-    results = joblib.Parallel(n_jobs=24, verbose=10, pre_dispatch="all")(
+    results = joblib.Parallel(n_jobs=args.n_jobs, verbose=10, pre_dispatch="all")(
         [joblib.delayed(multi_process)(a, args) for i, a in enumerate(anno)]
     )
 
@@ -299,6 +344,7 @@ def get_arguments():
                         default='./data/CIHP/cascade_152__finetune/gt_result-cihp-resnet101/gt_output')
     parser.add_argument("--mask_output_dir", type=str, default='./data/CIHP/cascade_152_finetune/mask')
     parser.add_argument("--save_dir", type=str, default='./data/CIHP/fusion_results/cihp-msrcnn_finetune')
+    parser.add_argument("--n_jobs", type=int, default=24)
     return parser.parse_args()
 
 
@@ -10,8 +10,9 @@ import numpy as np
 import cv2
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
-from datasets.simple_extractor_dataset import SimpleFolderDataset
-from utils.transforms import transform_logits
+from concurrent.futures import ThreadPoolExecutor
+from datasets.simple_extractor_dataset import SimpleFolderDataset, MultiSizeFolderDataset
+from utils.transforms import transform_logits, transform_logits_torch
 from tqdm import tqdm
 from PIL import Image
 
@@ -118,7 +119,16 @@ def refine_hole(parsing_result_filled, parsing_result, arm_mask):
             cv2.drawContours(refine_hole_mask, contours, i, color=255, thickness=-1)
     return refine_hole_mask + arm_mask
 
-def onnx_inference(session, lip_session, input_dir):
+# CHW logits 를 원본 이미지 좌표로 warp 한 뒤 argmax
+# torch_warp: transform_logits_torch (grid_sample, tensor device 에서 한 번에) 사용, 기본은 cv2 와 같은 결과의 transform_logits
+def warp_argmax(logits, c, s, w, h, input_size, torch_warp=False):
+    if torch_warp:
+        return transform_logits_torch(logits, c, s, w, h, input_size=input_size).argmax(dim=2).cpu().numpy()
+    logits_result = transform_logits(logits.permute(1, 2, 0).cpu().numpy(), c, s, w, h, input_size=input_size)
+    return np.argmax(logits_result, axis=2)
+
+
+def onnx_inference(session, lip_session, input_dir, torch_warp=False):
     transform = transforms.Compose([
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.406, 0.456, 0.485], std=[0.225, 0.224, 0.229])
@@ -135,25 +145,8 @@ def onnx_inference(session, lip_session, input_dir):
             output = session.run(None, {"input.1": image.numpy().astype(np.float32)})
             upsample = torch.nn.Upsample(size=[512, 512], mode='bilinear', align_corners=True)
             upsample_output = upsample(torch.from_numpy(output[1][0]).unsqueeze(0))
-            upsample_output = upsample_output.squeeze()
-            upsample_output = upsample_output.permute(1, 2, 0)  # CHW -> HWC
-            logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=[512, 512])
-            parsing_result = np.argmax(logits_result, axis=2)
-            parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
-            # try holefilling the clothes part
-            arm_mask = (parsing_result == 14).astype(np.float32) \
-                       + (parsing_result == 15).astype(np.float32)
-            upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
-            img = np.where(upper_cloth_mask, 255, 0)
-            dst = hole_fill(img.astype(np.uint8))
-            parsing_result_filled = dst / 255 * 4
-            parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
-            # add back arm and refined hole between arm and cloth
-            refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
-                                           arm_mask.astype(np.uint8))
-            parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
-            # remove padding
-            parsing_result = parsing_result[1:-1, 1:-1]
+            parsing_result = refine_atr_parsing(
+                warp_argmax(upsample_output.squeeze(0), c, s, w, h, [512, 512], torch_warp))
 
         dataset_lip = SimpleFolderDataset(root=input_dir, input_size=[473, 473], transform=transform)
         dataloader_lip = DataLoader(dataset_lip)
@@ -168,11 +161,29 @@ def onnx_inference(session, lip_session, input_dir):
                 output_lip = lip_session.run(None, {"input.1": image.numpy().astype(np.float32)})
                 upsample = torch.nn.Upsample(size=[473, 473], mode='bilinear', align_corners=True)
                 upsample_output_lip = upsample(torch.from_numpy(output_lip[1][0]).unsqueeze(0))
-                upsample_output_lip = upsample_output_lip.squeeze()
-                upsample_output_lip = upsample_output_lip.permute(1, 2, 0)  # CHW -> HWC
-                logits_result_lip = transform_logits(upsample_output_lip.data.cpu().numpy(), c, s, w, h,
-                                                     input_size=[473, 473])
-                parsing_result_lip = np.argmax(logits_result_lip, axis=2)
+                parsing_result_lip = warp_argmax(upsample_output_lip.squeeze(0), c, s, w, h, [473, 473], torch_warp)
+    return compose_parsing(parsing_result, parsing_result_lip)
+
+
+def refine_atr_parsing(parsing_result):
+    parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
+    # try holefilling the clothes part
+    arm_mask = (parsing_result == 14).astype(np.float32) \
+               + (parsing_result == 15).astype(np.float32)
+    upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
+    img = np.where(upper_cloth_mask, 255, 0)
+    dst = hole_fill(img.astype(np.uint8))
+    parsing_result_filled = dst / 255 * 4
+    parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
+    # add back arm and refined hole between arm and cloth
+    refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
+                                   arm_mask.astype(np.uint8))
+    parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
+    # remove padding
+    return parsing_result[1:-1, 1:-1]
+
+
+def compose_parsing(parsing_result, parsing_result_lip):
     # add neck parsing result
     neck_mask = np.logical_and(np.logical_not((parsing_result_lip == 13).astype(np.float32)),
                                (parsing_result == 11).astype(np.float32))
@@ -185,4 +196,56 @@ def onnx_inference(session, lip_session, input_dir):
     return output_img, face_mask
 
 
+def run_session(session, images):
+    # graphs exported with a fixed batch dimension of 1 are run sample by sample
+    batch_dim = session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim == 1 and images.shape[0] > 1:
+        return np.concatenate([session.run(None, {"input.1": images[i:i + 1]})[1] for i in range(images.shape[0])])
+    return session.run(None, {"input.1": images})[1]
+
+
+def onnx_inference_batched(session, lip_session, inputs, batch_size=8, num_workers=4, torch_warp=False):
+    """ Batched ATR + LIP parsing, yields (name, output_img, face_mask) per image.
+    Every image is decoded once in the DataLoader workers, which also warp it to both 512 and 473 inputs.
+    The two sessions run side by side in threads (onnxruntime releases the GIL), and the post-processing of
+    one batch overlaps with the inference of the next.
+    Args:
+        inputs: image folder, image path or list of image paths / PIL images
+        torch_warp: warp the logits with transform_logits_torch instead of the exact cv2 path
+    """
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.406, 0.456, 0.485], std=[0.225, 0.224, 0.229])
+    ])
+    dataset = MultiSizeFolderDataset(inputs, input_sizes=[[512, 512], [473, 473]], transform=transform)
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    upsample = torch.nn.Upsample(size=[512, 512], mode='bilinear', align_corners=True)
+    upsample_lip = torch.nn.Upsample(size=[473, 473], mode='bilinear', align_corners=True)
+
+    def postprocess(output, output_lip, meta):
+        logits = upsample(torch.from_numpy(output.result()))
+        logits_lip = upsample_lip(torch.from_numpy(output_lip.result()))
+        for i in range(logits.shape[0]):
+            c = meta['center'].numpy()[i]
+            s = meta['scale'].numpy()[i]
+            w = meta['width'].numpy()[i]
+            h = meta['height'].numpy()[i]
+            parsing_result = warp_argmax(logits[i], c, s, w, h, [512, 512], torch_warp)
+            parsing_result_lip = warp_argmax(logits_lip[i], c, s, w, h, [473, 473], torch_warp)
+            output_img, face_mask = compose_parsing(refine_atr_parsing(parsing_result), parsing_result_lip)
+            yield meta['name'][i], output_img, face_mask
+
+    with torch.no_grad(), ThreadPoolExecutor(max_workers=2) as executor:
+        pending = None
+        for (image, image_lip), meta in tqdm(dataloader):
+            submitted = (executor.submit(run_session, session, image.numpy().astype(np.float32)),
+                         executor.submit(run_session, lip_session, image_lip.numpy().astype(np.float32)),
+                         meta)
+            if pending is not None:
+                yield from postprocess(*pending)
+            pending = submitted
+        if pending is not None:
+            yield from postprocess(*pending)
+
+
 
@@ -2,31 +2,127 @@ import pdb
 from pathlib import Path
 import sys
 import os
+import queue
+import threading
+import numpy as np
 import onnxruntime as ort
 from PIL import Image
 
 PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
 sys.path.insert(0, str(PROJECT_ROOT))
-from parsing_api import onnx_inference
+from parsing_api import onnx_inference, onnx_inference_batched
 import torch
 
 
+# onnxruntime session wrapper: input / output buffers are bound once per input shape and reused between calls.
+# The buffers are shared, so calls on the same session are serialized (onnx_inference_batched overlaps batches).
+class IOBoundSession:
+    def __init__(self, session, device='cpu', device_id=0):
+        self.session = session
+        self.device = device
+        self.device_id = device_id
+        self._bindings = {}  # input shape -> (input buffer, input OrtValue, output OrtValues, io_binding)
+        self._lock = threading.Lock()
+
+    def get_inputs(self):
+        return self.session.get_inputs()
+
+    def get_outputs(self):
+        return self.session.get_outputs()
+
+    def run(self, output_names, input_feed):
+        (name, array), = input_feed.items()
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            return self._run(name, array, output_names, input_feed)
+
+    def _run(self, name, array, output_names, input_feed):
+        if array.shape not in self._bindings:
+            # the first call of a shape runs normally to learn the output shapes
+            outputs = self.session.run(output_names, input_feed)
+            io_binding = self.session.io_binding()
+            if self.device == 'cpu':
+                input_buffer = np.empty_like(array)
+                input_value = ort.OrtValue.ortvalue_from_numpy(input_buffer)
+            else:
+                input_buffer = None
+                input_value = ort.OrtValue.ortvalue_from_numpy(array, self.device, self.device_id)
+            io_binding.bind_ortvalue_input(name, input_value)
+            output_values = []
+            for output, result in zip(self.session.get_outputs(), outputs):
+                value = ort.OrtValue.ortvalue_from_shape_and_type(result.shape, result.dtype, self.device,
+                                                                  self.device_id)
+                io_binding.bind_ortvalue_output(output.name, value)
+                output_values.append(value)
+            self._bindings[array.shape] = (input_buffer, input_value, output_values, io_binding)
+            return outputs
+
+        input_buffer, input_value, output_values, io_binding = self._bindings[array.shape]
+        if input_buffer is not None:
+            np.copyto(input_buffer, array)
+        else:
+            input_value.update_inplace(array)
+        self.session.run_with_iobinding(io_binding)
+        return [value.numpy() for value in output_values]
+
+
 class Parsing:
-    def __init__(self, gpu_id: int):
+    """
+    ATR + LIP human parsing on onnxruntime.
+    Args:
+        gpu_id: device id used by the CUDA execution provider
+        providers: onnxruntime execution providers, CPU only by default
+        intra_op_num_threads / inter_op_num_threads: onnxruntime thread pools, 0 lets onnxruntime decide
+        parallel: ORT_PARALLEL execution mode instead of ORT_SEQUENTIAL
+        num_replicas: number of (ATR, LIP) session pairs, concurrent callers each take one from the pool
+        io_binding: reuse bound input / output buffers between calls
+        torch_warp: warp the logits with grid_sample (transform_logits_torch), close to but not bit-identical
+            with the default cv2.warpAffine path
+    """
+    def __init__(self, gpu_id: int, providers=None, intra_op_num_threads=0, inter_op_num_threads=0, parallel=False,
+                 num_replicas=1, io_binding=False, torch_warp=False):
         self.gpu_id = gpu_id
-        torch.cuda.set_device(gpu_id)
+        self.torch_warp = torch_warp
+        providers = providers or ['CPUExecutionProvider']
+        if 'CUDAExecutionProvider' in providers:
+            torch.cuda.set_device(gpu_id)
+        provider_options = [{'device_id': str(gpu_id)} if provider == 'CUDAExecutionProvider' else {}
+                            for provider in providers]
         session_options = ort.SessionOptions()
         session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-        session_options.add_session_config_entry('gpu_id', str(gpu_id))
-        self.session = ort.InferenceSession(
-            os.path.join(Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing/parsing_atr.onnx'),
-            sess_options=session_options, providers=['CPUExecutionProvider'])
-        self.lip_session = ort.InferenceSession(os.path.join(
-            Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing/parsing_lip.onnx'),
-            sess_options=session_options, providers=['CPUExecutionProvider'])
+        session_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if parallel \
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+        session_options.intra_op_num_threads = intra_op_num_threads
+        session_options.inter_op_num_threads = inter_op_num_threads
+        device = 'cuda' if providers[0] == 'CUDAExecutionProvider' else 'cpu'
+
+        ckpt_dir = os.path.join(Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing')
+        self._pool = queue.Queue()
+        for _ in range(num_replicas):
+            sessions = []
+            for name in ('parsing_atr.onnx', 'parsing_lip.onnx'):
+                session = ort.InferenceSession(os.path.join(ckpt_dir, name), sess_options=session_options,
+                                               providers=providers, provider_options=provider_options)
+                if io_binding:
+                    session = IOBoundSession(session, device=device, device_id=gpu_id)
+                sessions.append(session)
+            self._pool.put(tuple(sessions))
+        self.session, self.lip_session = self._pool.queue[0]
 
     def __call__(self, input_image):
         # torch.cuda.set_device(self.gpu_id)
-        parsed_image, face_mask = onnx_inference(self.session, self.lip_session, input_image)
+        session, lip_session = self._pool.get()
+        try:
+            parsed_image, face_mask = onnx_inference(session, lip_session, input_image, torch_warp=self.torch_warp)
+        finally:
+            self._pool.put((session, lip_session))
         return parsed_image, face_mask
+
+    # 폴더 / 이미지 리스트를 batch 로 처리, 이미지마다 (name, parsed_image, face_mask) 를 yield
+    def batch(self, inputs, batch_size=8, num_workers=4):
+        session, lip_session = self._pool.get()
+        try:
+            yield from onnx_inference_batched(session, lip_session, inputs, batch_size=batch_size,
+                                              num_workers=num_workers, torch_warp=self.torch_warp)
+        finally:
+            self._pool.put((session, lip_session))
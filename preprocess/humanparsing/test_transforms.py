@@ -0,0 +1,33 @@
+from pathlib import Path
+import sys
+
+PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
+sys.path.insert(0, str(PROJECT_ROOT))
+import numpy as np
+import cv2
+from utils.transforms import get_affine_transform, transform_logits
+
+
+def warp_per_channel(logits, center, scale, width, height, input_size):
+    # the original per-channel cv2.warpAffine loop
+    trans = get_affine_transform(center, scale, 0, input_size, inv=1)
+    return np.stack([
+        cv2.warpAffine(logits[:, :, i], trans, (int(width), int(height)), flags=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=(0))
+        for i in range(logits.shape[2])
+    ], axis=2)
+
+
+def test_transform_logits_matches_cv2():
+    rng = np.random.RandomState(0)
+    for channel, input_size in [(20, [473, 473]), (18, [512, 512]), (1, [473, 473]), (2, [473, 473]),
+                                (3, [512, 512]), (6, [512, 512])]:
+        logits = (rng.randn(input_size[0], input_size[1], channel) * 5).astype(np.float32)
+        center = np.array([rng.uniform(100, 300), rng.uniform(100, 400)], dtype=np.float32)
+        scale = np.array([rng.uniform(200, 500)] * 2, dtype=np.float32)
+        width, height = rng.randint(300, 700, size=2)
+
+        expected = warp_per_channel(logits, center, scale, width, height, input_size)
+        result = transform_logits(logits, center, scale, width, height, input_size)
+        assert result.shape == expected.shape
+        assert np.array_equal(result, expected)
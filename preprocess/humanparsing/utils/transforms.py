@@ -79,24 +79,62 @@ def transform_parsing(pred, center, scale, width, height, input_size):
     return target_pred
 
 def transform_logits(logits, center, scale, width, height, input_size):
-
+    # (H, W, C) numpy in and out, same values as a cv2.warpAffine per channel
     trans = get_affine_transform(center, scale, 0, input_size, inv=1)
     channel = logits.shape[2]
-    target_logits = []
-    for i in range(channel):
+    target_logits = np.empty((int(height), int(width), channel), dtype=logits.dtype)
+    # channels are warped 4 (or 3, 1) at a time, the 2-channel warpAffine path differs at the border
+    start = 0
+    while start < channel:
+        step = min(4, channel - start)
+        if step == 2:
+            step = 1
         target_logit = cv2.warpAffine(
-            logits[:,:,i],
+            np.ascontiguousarray(logits[:, :, start:start + step]),
             trans,
             (int(width), int(height)), #(int(width), int(height)),
             flags=cv2.INTER_LINEAR,
             borderMode=cv2.BORDER_CONSTANT,
             borderValue=(0))
-        target_logits.append(target_logit)
-    target_logits = np.stack(target_logits,axis=2)
+        target_logits[:, :, start:start + step] = target_logit.reshape(int(height), int(width), step)
+        start += step
 
     return target_logits
 
 
+def transform_logits_torch(logits, center, scale, width, height, input_size):
+    '''
+    logits: torch.Tensor(num_classes, height, width) or (batch_size, num_classes, height, width), on any device
+    returns the warped logits as a (height, width, num_classes) / (batch_size, height, width, num_classes) view,
+    ready for argmax over the last axis. Bilinear with zero border, approximating cv2.warpAffine per channel: the
+    sampling grid is the same, but grid_sample interpolates in float32 without warpAffine's fixed-point weights,
+    so values and the border pixels can differ slightly. Opt-in fast path, transform_logits stays exact.
+    '''
+    trans = get_affine_transform(center, scale, 0, input_size, inv=1)
+    # warpAffine samples the source at the inverse transform of every target pixel
+    inv_trans = torch.as_tensor(cv2.invertAffineTransform(trans), dtype=torch.float32, device=logits.device)
+
+    squeeze = logits.dim() == 3
+    if squeeze:
+        logits = logits.unsqueeze(0)
+    src_h, src_w = logits.shape[-2:]
+    ys, xs = torch.meshgrid(
+        torch.arange(int(height), dtype=torch.float32, device=logits.device),
+        torch.arange(int(width), dtype=torch.float32, device=logits.device),
+        indexing="ij")
+    src_x = inv_trans[0, 0] * xs + inv_trans[0, 1] * ys + inv_trans[0, 2]
+    src_y = inv_trans[1, 0] * xs + inv_trans[1, 1] * ys + inv_trans[1, 2]
+    # align_corners=True: -1 / 1 are the centers of the first / last source pixel
+    grid = torch.stack([src_x * (2. / (src_w - 1)) - 1, src_y * (2. / (src_h - 1)) - 1], dim=-1)
+    grid = grid.unsqueeze(0).expand(logits.shape[0], -1, -1, -1)
+
+    target_logits = torch.nn.functional.grid_sample(
+        logits.float(), grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+    target_logits = target_logits.permute(0, 2, 3, 1)  # NCHW -> NHWC
+
+    return target_logits[0] if squeeze else target_logits
+
+
 def get_affine_transform(center,
                          scale,
                          rot,
@@ -66,6 +66,10 @@ class OpenposeDetector:
 
 
     def __call__(self, oriImg, hand_and_face=False, return_is_index=False):
+        # a list or a stacked (N, H, W, 3) array goes through the batched body network
+        if isinstance(oriImg, (list, tuple)) or oriImg.ndim == 4:
+            return self.detect_batch(oriImg, return_is_index=return_is_index)
+
         oriImg = oriImg[:, :, ::-1].copy()
         H, W, C = oriImg.shape
         with torch.no_grad():
@@ -90,13 +94,30 @@ class OpenposeDetector:
                         peaks[:, 0] = np.where(peaks[:, 0] < 1e-6, -1, peaks[:, 0] + x) / float(W)
                         peaks[:, 1] = np.where(peaks[:, 1] < 1e-6, -1, peaks[:, 1] + y) / float(H)
                         faces.append(peaks.tolist())
-            if candidate.ndim == 2 and candidate.shape[1] == 4:
-                candidate = candidate[:, :2]
-                candidate[:, 0] /= float(W)
-                candidate[:, 1] /= float(H)
-            bodies = dict(candidate=candidate.tolist(), subset=subset.tolist())
-            pose = dict(bodies=bodies, hands=hands, faces=faces)
+            pose = self._format_pose(candidate, subset, H, W, hands, faces)
             if return_is_index:
                 return pose
             else:
                 return pose, draw_pose(pose, H, W)
+
+    # 이미지 리스트를 batch_size 단위로 body network 에 한 번에 넣음 (body only)
+    def detect_batch(self, oriImgs, return_is_index=False, batch_size=16):
+        oriImgs = [oriImg[:, :, ::-1].copy() for oriImg in oriImgs]
+        results = []
+        with torch.no_grad():
+            for start in range(0, len(oriImgs), batch_size):
+                chunk = oriImgs[start:start + batch_size]
+                for oriImg, (candidate, subset) in zip(chunk, self.body_estimation.batch(chunk)):
+                    H, W, C = oriImg.shape
+                    pose = self._format_pose(candidate, subset, H, W)
+                    results.append(pose if return_is_index else (pose, draw_pose(pose, H, W)))
+        return results
+
+    @staticmethod
+    def _format_pose(candidate, subset, H, W, hands=None, faces=None):
+        if candidate.ndim == 2 and candidate.shape[1] == 4:
+            candidate = candidate[:, :2]
+            candidate[:, 0] /= float(W)
+            candidate[:, 1] /= float(H)
+        bodies = dict(candidate=candidate.tolist(), subset=subset.tolist())
+        return dict(bodies=bodies, hands=hands or [], faces=faces or [])
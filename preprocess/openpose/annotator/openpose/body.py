@@ -11,14 +11,35 @@ from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 import matplotlib
 import torch
+import torch.nn.functional as F
 from torchvision import transforms
 
 from . import util
 from .model import bodypose_model
 
 
+def _symmetric_index(n, radius, device):
+    # scipy.ndimage 'reflect' boundary (d c b a | a b c d | d c b a), periodic with 2n for radius > n
+    index = torch.remainder(torch.arange(-radius, n + radius, device=device), 2 * n)
+    return torch.where(index >= n, 2 * n - 1 - index, index)
+
+
+def gaussian_filter_torch(x, sigma, truncate=4.0):
+    # x: (C, H, W), separable gaussian with the same kernel and boundary as scipy.ndimage.gaussian_filter
+    radius = int(truncate * sigma + 0.5)
+    offsets = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+    kernel = torch.exp(-0.5 / sigma ** 2 * offsets ** 2)
+    kernel = kernel / kernel.sum()
+
+    C, H, W = x.shape
+    x = x[:, _symmetric_index(H, radius, x.device)][:, :, _symmetric_index(W, radius, x.device)].unsqueeze(1)
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1))
+    x = F.conv2d(x, kernel.view(1, 1, 1, -1))
+    return x.squeeze(1)
+
+
 class Body(object):
-    def __init__(self, model_path):
+    def __init__(self, model_path, gpu_postprocess=False):
         self.model = bodypose_model()
         if torch.cuda.is_available():
             self.model = self.model.cuda()
@@ -26,9 +47,17 @@ class Body(object):
         model_dict = util.transfer(self.model, torch.load(model_path))
         self.model.load_state_dict(model_dict)
         self.model.eval()
+        # upsampling, smoothing and peak finding on the GPU (opt-in). The peak list comes back, and the full
+        # resolution PAF is still copied to the host as float32 for limb matching
+        self.gpu_postprocess = gpu_postprocess
 
 
     def __call__(self, oriImg):
+        return self.batch([oriImg])[0]
+
+    # 여러 이미지를 stride 8 의 공통 크기로 padding 해서 body network 를 한 번에 실행
+    # 이미지마다 (candidate, subset) 반환
+    def batch(self, oriImgs):
         # scale_search = [0.5, 1.0, 1.5, 2.0]
         scale_search = [0.5]
         boxsize = 368
@@ -36,43 +65,110 @@ class Body(object):
         padValue = 128
         thre1 = 0.1
         thre2 = 0.05
-        multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
-        heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 19))
-        paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
-
-        for m in range(len(multiplier)):
-            scale = multiplier[m]
-            imageToTest = util.smart_resize_k(oriImg, fx=scale, fy=scale)
-            imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
-            im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
+        gpu_postprocess = self.gpu_postprocess and torch.cuda.is_available()
+        if gpu_postprocess:
+            heatmap_avgs = [0] * len(oriImgs)
+            paf_avgs = [0] * len(oriImgs)
+        else:
+            heatmap_avgs = [np.zeros((oriImg.shape[0], oriImg.shape[1], 19)) for oriImg in oriImgs]
+            paf_avgs = [np.zeros((oriImg.shape[0], oriImg.shape[1], 38)) for oriImg in oriImgs]
+
+        for m in range(len(scale_search)):
+            imagesToTest = []
+            for oriImg in oriImgs:
+                scale = scale_search[m] * boxsize / oriImg.shape[0]
+                imagesToTest.append(util.smart_resize_k(oriImg, fx=scale, fy=scale))
+
+            # pad right / down to the largest size, rounded up to the stride
+            padded_h = max(image.shape[0] for image in imagesToTest)
+            padded_w = max(image.shape[1] for image in imagesToTest)
+            padded_h += 0 if (padded_h % stride == 0) else stride - (padded_h % stride)
+            padded_w += 0 if (padded_w % stride == 0) else stride - (padded_w % stride)
+            imagesToTest_padded = np.full((len(oriImgs), padded_h, padded_w, 3), padValue, dtype=np.float32)
+            for n, imageToTest in enumerate(imagesToTest):
+                imagesToTest_padded[n, :imageToTest.shape[0], :imageToTest.shape[1]] = imageToTest
+            im = np.transpose(imagesToTest_padded, (0, 3, 1, 2)) / 256 - 0.5
             im = np.ascontiguousarray(im)
 
             data = torch.from_numpy(im).float()
             if torch.cuda.is_available():
                 data = data.cuda()
-            # data = data.permute([2, 0, 1]).unsqueeze(0).float()
             with torch.no_grad():
                 Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
 
-            Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
-            Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
-
-            # extract outputs, resize, and remove padding
-            # heatmap = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[1]].data), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = np.transpose(np.squeeze(Mconv7_stage6_L2), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = util.smart_resize_k(heatmap, fx=stride, fy=stride)
-            heatmap = heatmap[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
-            heatmap = util.smart_resize(heatmap, (oriImg.shape[0], oriImg.shape[1]))
-
-            # paf = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[0]].data), (1, 2, 0))  # output 0 is PAFs
-            paf = np.transpose(np.squeeze(Mconv7_stage6_L1), (1, 2, 0))  # output 0 is PAFs
-            paf = util.smart_resize_k(paf, fx=stride, fy=stride)
-            paf = paf[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
-            paf = util.smart_resize(paf, (oriImg.shape[0], oriImg.shape[1]))
-
-            heatmap_avg += heatmap_avg + heatmap / len(multiplier)
-            paf_avg += + paf / len(multiplier)
-
+            if not gpu_postprocess:
+                Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
+                Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
+
+            for n, oriImg in enumerate(oriImgs):
+                valid_shape = imagesToTest[n].shape[:2]
+                if gpu_postprocess:
+                    # all 19 heatmap / 38 PAF channels are resized in one op each, (C, H, W) float32 on the device
+                    heatmap = self._resize_maps_gpu(Mconv7_stage6_L2[n], stride, valid_shape, oriImg.shape[:2])
+                    paf = self._resize_maps_gpu(Mconv7_stage6_L1[n], stride, valid_shape, oriImg.shape[:2])
+                    heatmap_avgs[n] = heatmap_avgs[n] + heatmap / len(scale_search)
+                    paf_avgs[n] = paf_avgs[n] + paf / len(scale_search)
+                    continue
+
+                # extract outputs, resize, and remove padding
+                heatmap = np.transpose(Mconv7_stage6_L2[n], (1, 2, 0))  # output 1 is heatmaps
+                heatmap = util.smart_resize_k(heatmap, fx=stride, fy=stride)
+                heatmap = heatmap[:valid_shape[0], :valid_shape[1], :]
+                heatmap = util.smart_resize(heatmap, (oriImg.shape[0], oriImg.shape[1]))
+
+                paf = np.transpose(Mconv7_stage6_L1[n], (1, 2, 0))  # output 0 is PAFs
+                paf = util.smart_resize_k(paf, fx=stride, fy=stride)
+                paf = paf[:valid_shape[0], :valid_shape[1], :]
+                paf = util.smart_resize(paf, (oriImg.shape[0], oriImg.shape[1]))
+
+                heatmap_avgs[n] += heatmap_avgs[n] + heatmap / len(scale_search)
+                paf_avgs[n] += + paf / len(scale_search)
+
+        results = []
+        for oriImg, heatmap_avg, paf_avg in zip(oriImgs, heatmap_avgs, paf_avgs):
+            if gpu_postprocess:
+                all_peaks = self._find_peaks_gpu(heatmap_avg, thre1)
+                # the PAFs are only sampled along candidate limbs, float32 is enough
+                paf_avg = paf_avg.permute(1, 2, 0).cpu().numpy()
+            else:
+                all_peaks = self._find_peaks(heatmap_avg, thre1)
+            results.append(self._connect(oriImg, all_peaks, paf_avg, thre2))
+        return results
+
+    @staticmethod
+    def _resize_maps_gpu(maps, stride, valid_shape, ori_shape):
+        # bicubic stands in for cv2 INTER_LANCZOS4 (upsampling) and area for INTER_AREA (downsampling)
+        maps = F.interpolate(maps.unsqueeze(0), scale_factor=stride, mode="bicubic", align_corners=False)
+        maps = maps[:, :, :valid_shape[0], :valid_shape[1]]
+        k = float(ori_shape[0] + ori_shape[1]) / float(valid_shape[0] + valid_shape[1])
+        if k < 1:
+            maps = F.interpolate(maps, size=tuple(ori_shape), mode="area")
+        else:
+            maps = F.interpolate(maps, size=tuple(ori_shape), mode="bicubic", align_corners=False)
+        return maps[0]
+
+    @staticmethod
+    def _find_peaks_gpu(heatmap_avg, thre1):
+        # heatmap_avg: (19, H, W) on the device, smoothing + 4-neighbour NMS for the 18 parts at once
+        map_ori = heatmap_avg[:18]
+        one_heatmap = gaussian_filter_torch(map_ori, sigma=3)
+        padded = F.pad(one_heatmap, (1, 1, 1, 1))
+        peaks_binary = (one_heatmap >= padded[:, :-2, 1:-1]) & (one_heatmap >= padded[:, 2:, 1:-1]) & \
+                       (one_heatmap >= padded[:, 1:-1, :-2]) & (one_heatmap >= padded[:, 1:-1, 2:]) & \
+                       (one_heatmap > thre1)
+
+        # (part, y, x) in row-major order, the same order as np.nonzero per part
+        peaks = torch.nonzero(peaks_binary)
+        scores = map_ori[peaks[:, 0], peaks[:, 1], peaks[:, 2]].cpu().numpy()
+        peaks = peaks.cpu().numpy()
+
+        all_peaks = [[] for _ in range(18)]
+        for peak_id, ((part, y, x), score) in enumerate(zip(peaks, scores)):
+            all_peaks[part].append((x, y, score, peak_id))
+        return all_peaks
+
+    @staticmethod
+    def _find_peaks(heatmap_avg, thre1):
         all_peaks = []
         peak_counter = 0
 
@@ -99,7 +195,10 @@ class Body(object):
 
             all_peaks.append(peaks_with_score_and_id)
             peak_counter += len(peaks)
+        return all_peaks
 
+    @staticmethod
+    def _connect(oriImg, all_peaks, paf_avg, thre2):
         # find connection in the specified sequence, center 29 is in the position 15
         limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
                    [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
@@ -121,49 +220,60 @@ class Body(object):
             nB = len(candB)
             indexA, indexB = limbSeq[k]
             if (nA != 0 and nB != 0):
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
-
-                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                          for I in range(len(startend))])
-                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                          for I in range(len(startend))])
-
-                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                            0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
-
-                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if (i not in connection[:, 3] and j not in connection[:, 4]):
-                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
+                candA = np.array(candA, dtype=np.float64).reshape(nA, 4)
+                candB = np.array(candB, dtype=np.float64).reshape(nB, 4)
+
+                # score every (i, j) candidate pair at once, vec / norm: (nA, nB, 2) / (nA, nB)
+                vec = candB[np.newaxis, :, :2] - candA[:, np.newaxis, :2]
+                norm = np.sqrt(vec[:, :, 0] * vec[:, :, 0] + vec[:, :, 1] * vec[:, :, 1])
+                norm = np.maximum(0.001, norm)
+                vec = vec / norm[:, :, np.newaxis]
+
+                # mid_num points on every segment, gathered from the PAF in one indexing op: (nA, nB, mid_num)
+                startend_x = np.linspace(candA[:, np.newaxis, 0], candB[np.newaxis, :, 0], num=mid_num, axis=-1)
+                startend_y = np.linspace(candA[:, np.newaxis, 1], candB[np.newaxis, :, 1], num=mid_num, axis=-1)
+                startend_x = np.round(startend_x).astype(int)
+                startend_y = np.round(startend_y).astype(int)
+                vec_x = score_mid[startend_y, startend_x, 0]
+                vec_y = score_mid[startend_y, startend_x, 1]
+
+                score_midpts = np.multiply(vec_x, vec[:, :, 0:1]) + np.multiply(vec_y, vec[:, :, 1:2])
+                # summed point by point in the same order as the builtin sum over the segment
+                score_sum = np.zeros((nA, nB))
+                for I in range(mid_num):
+                    score_sum = score_sum + score_midpts[:, :, I]
+                score_with_dist_prior = score_sum / mid_num + np.minimum(0.5 * oriImg.shape[0] / norm - 1, 0)
+                criterion1 = np.count_nonzero(score_midpts > thre2, axis=-1) > 0.8 * mid_num
+                criterion2 = score_with_dist_prior > 0
+
+                # candidates in (i, j) order, stable sort keeps that order for equal scores
+                cand_i, cand_j = np.nonzero(criterion1 & criterion2)
+                cand_score = score_with_dist_prior[cand_i, cand_j]
+                order = np.argsort(-cand_score, kind="stable")
+
+                usedA = np.zeros(nA, dtype=bool)
+                usedB = np.zeros(nB, dtype=bool)
+                connection = []
+                for c in order:
+                    i, j = cand_i[c], cand_j[c]
+                    if not usedA[i] and not usedB[j]:
+                        connection.append([candA[i, 3], candB[j, 3], cand_score[c], i, j])
+                        usedA[i] = True
+                        usedB[j] = True
                         if (len(connection) >= min(nA, nB)):
                             break
 
-                connection_all.append(connection)
+                connection_all.append(np.array(connection, dtype=np.float64).reshape(-1, 5))
             else:
                 special_k.append(k)
                 connection_all.append([])
 
         # last number in each row is the total parts number of that person
         # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
+        # every connection creates at most one person, so the rows are allocated once up front
         candidate = np.array([item for sublist in all_peaks for item in sublist])
+        subset = -1 * np.ones((sum(len(connection) for connection in connection_all), 20))
+        num_subset = 0
 
         for k in range(len(mapIdx)):
             if k not in special_k:
@@ -172,12 +282,9 @@ class Body(object):
                 indexA, indexB = np.array(limbSeq[k]) - 1
 
                 for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                            subset_idx[found] = j
-                            found += 1
+                    rows = subset[:num_subset]
+                    subset_idx = np.nonzero((rows[:, indexA] == partAs[i]) | (rows[:, indexB] == partBs[i]))[0]
+                    found = len(subset_idx)
 
                     if found == 1:
                         j = subset_idx[0]
@@ -192,7 +299,10 @@ class Body(object):
                             subset[j1][:-2] += (subset[j2][:-2] + 1)
                             subset[j1][-2:] += subset[j2][-2:]
                             subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
+                            # drop row j2, keeping the order of the remaining rows
+                            subset[j2:num_subset - 1] = subset[j2 + 1:num_subset]
+                            num_subset -= 1
+                            subset[num_subset] = -1
                         else:  # as like found == 1
                             subset[j1][indexB] = partBs[i]
                             subset[j1][-1] += 1
@@ -200,18 +310,17 @@ class Body(object):
 
                     # if find no partA in the subset, create a new subset
                     elif not found and k < 17:
-                        row = -1 * np.ones(20)
+                        row = subset[num_subset]
                         row[indexA] = partAs[i]
                         row[indexB] = partBs[i]
                         row[-1] = 2
                         row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
+                        num_subset += 1
+        subset = subset[:num_subset]
+
         # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
+        deleteIdx = (subset[:, -1] < 4) | (subset[:, -2] / subset[:, -1] < 0.4)
+        subset = subset[~deleteIdx]
 
         # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
         # candidate: x, y, score, id
@@ -0,0 +1,145 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import sys
+
+PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
+sys.path.insert(0, str(PROJECT_ROOT))
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from preprocess.openpose.annotator.util import HWC3, resize_image
+from preprocess.openpose.annotator.openpose import draw_pose
+
+NUM_BODY_KEYPOINTS = 18
+
+
+def _person_keypoints(points):
+    # [x, y], [x, y, score] 또는 OpenPose 의 flat pose_keypoints_2d 모두 허용
+    points = list(points)
+    if len(points) and not isinstance(points[0], (list, tuple, type(None))):
+        step = 3 if len(points) == NUM_BODY_KEYPOINTS * 3 else 2
+        points = [points[i:i + step] for i in range(0, len(points), step)]
+    if len(points) != NUM_BODY_KEYPOINTS:
+        raise ValueError(f"expected {NUM_BODY_KEYPOINTS} body keypoints, got {len(points)}")
+    return points
+
+
+# 18-point body keypoints (pixel 좌표) 를 draw_pose 가 받는 pose dict 로 변환
+def keypoints_to_pose(keypoints, width, height):
+    if isinstance(keypoints, dict):
+        keypoints = keypoints["pose_keypoints_2d"]
+    # a single person or a list of people
+    if len(keypoints) and isinstance(keypoints[0], (list, tuple)) and len(keypoints[0]) \
+            and isinstance(keypoints[0][0], (list, tuple, type(None))):
+        people = keypoints
+    else:
+        people = [keypoints]
+
+    candidate, subset = [], []
+    for points in people:
+        row = [-1] * NUM_BODY_KEYPOINTS
+        for i, point in enumerate(_person_keypoints(points)):
+            # missing joints are None, [0, 0] (run_openpose) or have a zero score
+            if point is None or (point[0] <= 0 and point[1] <= 0) or (len(point) > 2 and point[2] <= 0):
+                continue
+            row[i] = len(candidate)
+            candidate.append([point[0] / float(width), point[1] / float(height)])
+        subset.append(row + [1.0, float(sum(index != -1 for index in row))])
+
+    bodies = dict(candidate=candidate, subset=subset)
+    return dict(bodies=bodies, hands=[], faces=[])
+
+
+# keypoints 를 body network 없이 바로 ControlNet pose map 으로 그림
+def render_pose_keypoints(keypoints, width=512, height=640, image_width=None, image_height=None):
+    if isinstance(keypoints, dict):
+        image_width = image_width or keypoints.get("width")
+        image_height = image_height or keypoints.get("height")
+    pose = keypoints_to_pose(keypoints, image_width or width, image_height or height)
+    canvas = draw_pose(pose, height, width, draw_hand=False, draw_face=False)
+    return Image.fromarray(HWC3(canvas))
+
+
+# 포즈 이미지 내용 해시 기반 pose map / keypoint 캐시
+class PoseMapCache:
+    r"""
+    Content-addressed cache of ControlNet pose conditioning. For every distinct pose image the rendered pose map
+    and the detected 18-point body keypoints are kept, so repeated poses skip the body network.
+
+    Args:
+        detector (`controlnet_aux.OpenposeDetector`):
+            Detector run on cache misses.
+        max_items (`int`, defaults to 256):
+            Number of pose images kept, least recently used entries are dropped first.
+        detect_resolution (`int`, defaults to 512):
+            Short side the pose image is resized to before detection.
+        image_resolution (`int`, defaults to 512):
+            Short side of the returned pose map, as `image_resolution` of `OpenposeDetector.__call__`. The keypoints
+            stay in `detect_resolution` pixels.
+    """
+
+    def __init__(self, detector, max_items=256, detect_resolution=512, image_resolution=512):
+        self.detector = detector
+        self.max_items = max_items
+        self.detect_resolution = detect_resolution
+        self.image_resolution = image_resolution
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_image(image):
+        image = np.ascontiguousarray(np.asarray(image))
+        h = hashlib.sha1()
+        h.update(str((image.shape, str(image.dtype))).encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def detect(self, image):
+        input_image = HWC3(np.asarray(image, dtype=np.uint8))
+        image = resize_image(input_image, self.detect_resolution)
+        H, W, C = image.shape
+        keypoints = []
+        for result in self.detector.detect_poses(image):
+            keypoints.append([
+                [keypoint.x * W, keypoint.y * H] if keypoint is not None else None
+                for keypoint in result.body.keypoints
+            ])
+        pose = keypoints_to_pose(keypoints, W, H) if keypoints else dict(
+            bodies=dict(candidate=[], subset=[]), hands=[], faces=[])
+        pose_map = HWC3(draw_pose(pose, H, W, draw_hand=False, draw_face=False))
+        if self.image_resolution != self.detect_resolution:
+            # same output size as resize_image(input_image, image_resolution), without resizing the input again
+            k = float(self.image_resolution) / min(input_image.shape[:2])
+            size = (int(np.round(input_image.shape[1] * k / 64.0)) * 64,
+                    int(np.round(input_image.shape[0] * k / 64.0)) * 64)
+            pose_map = cv2.resize(pose_map, size, interpolation=cv2.INTER_LINEAR)
+        pose_map = Image.fromarray(pose_map)
+        return {"pose_map": pose_map, "keypoints": keypoints, "width": W, "height": H}
+
+    def __call__(self, image):
+        if isinstance(image, Image.Image):
+            image = image.convert("RGB")
+        key = self.hash_image(image)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        entry = self.detect(image)
+        with self._lock:
+            self._items[key] = entry
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return entry
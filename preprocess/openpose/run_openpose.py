@@ -32,50 +32,76 @@ class OpenPose:
         torch.cuda.set_device(gpu_id)
         self.preprocessor = OpenposeDetector()
 
-    def __call__(self, input_image, resolution=384):
+    def __call__(self, input_image, resolution=384, return_map=False):
+        # a list of images is detected in batches, see batch()
+        if isinstance(input_image, (list, tuple)):
+            return self.batch(input_image, resolution, return_map=return_map)
+
+        torch.cuda.set_device(self.gpu_id)
+        input_image = self._load_image(input_image, resolution)
+        with torch.no_grad():
+            pose, detected_map = self.preprocessor(input_image, hand_and_face=False)
+        H, W, C = input_image.shape
+        keypoints = self._keypoints(pose, H, W)
+        # with open("/home/aigc/ProjectVTON/OpenPose/keypoints/keypoints.json", "w") as f:
+        #     json.dump(keypoints, f)
+        #
+        # # print(candidate)
+        # output_image = cv2.resize(cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB), (768, 1024))
+        # cv2.imwrite('/home/aigc/ProjectVTON/OpenPose/keypoints/out_pose.jpg', output_image)
+
+        if return_map:
+            return keypoints, detected_map
+        return keypoints
+
+    # 이미지 리스트 (PIL / 경로 / 배열) 를 batch_size 단위로 한 번에 검출, 이미지마다 keypoints (와 pose map) 반환
+    def batch(self, input_images, resolution=384, return_map=False, batch_size=16):
         torch.cuda.set_device(self.gpu_id)
+        input_images = [self._load_image(input_image, resolution) for input_image in input_images]
+        outputs = self.preprocessor.detect_batch(input_images, batch_size=batch_size)
+
+        results = []
+        for input_image, (pose, detected_map) in zip(input_images, outputs):
+            H, W, C = input_image.shape
+            keypoints = self._keypoints(pose, H, W)
+            results.append((keypoints, detected_map) if return_map else keypoints)
+        return results
+
+    @staticmethod
+    def _load_image(input_image, resolution):
         if isinstance(input_image, Image.Image):
             input_image = np.asarray(input_image)
         elif type(input_image) == str:
             input_image = np.asarray(Image.open(input_image))
-        else:
+        elif not isinstance(input_image, np.ndarray):
             raise ValueError
-        with torch.no_grad():
-            input_image = HWC3(input_image)
-            input_image = resize_image(input_image, resolution)
-            H, W, C = input_image.shape
-            assert (H == 512 and W == 384), 'Incorrect input image shape'
-            pose, detected_map = self.preprocessor(input_image, hand_and_face=False)
-
-            candidate = pose['bodies']['candidate']
-            subset = pose['bodies']['subset'][0][:18]
-            for i in range(18):
-                if subset[i] == -1:
-                    candidate.insert(i, [0, 0])
-                    for j in range(i, 18):
-                        if(subset[j]) != -1:
-                            subset[j] += 1
-                elif subset[i] != i:
-                    candidate.pop(i)
-                    for j in range(i, 18):
-                        if(subset[j]) != -1:
-                            subset[j] -= 1
-
-            candidate = candidate[:18]
-
-            for i in range(18):
-                candidate[i][0] *= 384
-                candidate[i][1] *= 512
-
-            keypoints = {"pose_keypoints_2d": candidate}
-            # with open("/home/aigc/ProjectVTON/OpenPose/keypoints/keypoints.json", "w") as f:
-            #     json.dump(keypoints, f)
-            #
-            # # print(candidate)
-            # output_image = cv2.resize(cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB), (768, 1024))
-            # cv2.imwrite('/home/aigc/ProjectVTON/OpenPose/keypoints/out_pose.jpg', output_image)
-
-        return keypoints
+        input_image = HWC3(input_image)
+        return resize_image(input_image, resolution)
+
+    # 첫 번째 사람의 18 개 keypoint 를 pixel 좌표로 정렬 (없는 관절은 [0, 0])
+    @staticmethod
+    def _keypoints(pose, H, W):
+        candidate = pose['bodies']['candidate']
+        subset = pose['bodies']['subset'][0][:18]
+        for i in range(18):
+            if subset[i] == -1:
+                candidate.insert(i, [0, 0])
+                for j in range(i, 18):
+                    if(subset[j]) != -1:
+                        subset[j] += 1
+            elif subset[i] != i:
+                candidate.pop(i)
+                for j in range(i, 18):
+                    if(subset[j]) != -1:
+                        subset[j] -= 1
+
+        candidate = candidate[:18]
+
+        for i in range(18):
+            candidate[i][0] *= W
+            candidate[i][1] *= H
+
+        return {"pose_keypoints_2d": candidate}
 
 
 if __name__ == '__main__':
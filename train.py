@@ -12,6 +12,7 @@ from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import set_seed, DummyOptim, DummyScheduler
 from diffusers import AutoencoderKL,  UNet2DConditionModel, DDIMScheduler
+from diffusers.models.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPVisionModelWithProjection
 
@@ -22,8 +23,9 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 
 from adapter.resampler import Resampler
-from IGPair import VDDataset, collate_fn
+from IGPair import VDDataset, VDShardDataset, BatchImageDecoder, collate_fn
 from adapter.attention_processor import CacheAttnProcessor2_0,  CAttnProcessor2_0, RefSAttnProcessor2_0
+from dressing_sd.pipelines.garment_cache import GarmentFeatureCache
 
 logger = get_logger(__name__)
 
@@ -70,6 +72,56 @@ def parse_args():
         default=None,
         help="Path to dataset json file.",
     )
+    parser.add_argument(
+        "--dataset_shard_dir",
+        type=str,
+        default=None,
+        help="Directory written by make_igpair_shards.py. If set, samples are streamed from its tar shards "
+             "instead of being read through the dataset json.",
+    )
+    parser.add_argument(
+        "--pretokenize_captions",
+        action="store_true",
+        help="Tokenize every caption once up front, the data workers then only return caption indices.",
+    )
+    parser.add_argument(
+        "--gpu_decode",
+        action="store_true",
+        help="Ship compressed images from the data workers and decode / augment them on the GPU.",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers", type=int, default=4, help="Number of subprocesses used for data loading."
+    )
+    parser.add_argument(
+        "--freeze_reference",
+        action="store_true",
+        help="Freeze ref_unet and proj and only train adapter_modules. The reference pass then runs without "
+             "gradients, once for all gradient accumulation micro-steps of an optimizer step. The latents and "
+             "reference hidden states of all those micro-batches stay on the GPU together, about 29MB of fp16 "
+             "hidden states per sample at 640x512.",
+    )
+    parser.add_argument(
+        "--reference_cache_size",
+        type=int,
+        default=0,
+        help="With --freeze_reference and --feature_dir, number of reference hidden states kept on the GPU, keyed "
+             "on the garment (cloth_file) and its precomputed crop, so all pairs wearing a garment share "
+             "num_crops x 2 (dropped image embedding) entries. Cached garments use the mean of their latent "
+             "distribution instead of a sample. About 29MB per entry in fp16. 0 disables the cache.",
+    )
+    parser.add_argument(
+        "--reference_cache_cpu_size",
+        type=int,
+        default=0,
+        help="Number of cached reference hidden states kept in host memory after leaving the GPU.",
+    )
+    parser.add_argument(
+        "--feature_dir",
+        type=str,
+        default=None,
+        help="Directory written by precompute_features.py. If set, latents and embeddings are read from it and "
+             "the frozen vae, text and image encoders are not run.",
+    )
 
     parser.add_argument(
         "--output_dir",
@@ -169,6 +221,12 @@ def parse_args():
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
 
     args = parser.parse_args()
+    if args.dataset_shard_dir is not None and (args.feature_dir is not None or args.pretokenize_captions):
+        # the shards hold JPEG bytes and raw captions, neither the precomputed features nor the token table
+        raise ValueError("--dataset_shard_dir can't be combined with --feature_dir or --pretokenize_captions")
+    if args.reference_cache_size > 0 and args.feature_dir is None:
+        # random crops are drawn every pass, the same garment input would practically never come back
+        raise ValueError("--reference_cache_size needs the precomputed crops of --feature_dir")
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
         args.local_rank = env_local_rank
@@ -207,6 +265,18 @@ def load_training_checkpoint(model, load_dir, tag=None, **kwargs):
     return (epoch, last_global_step)
 
 
+# gradient accumulation 의 micro-step 들을 한 묶음으로
+def grouped(iterable, n):
+    group = []
+    for item in iterable:
+        group.append(item)
+        if len(group) == n:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
 def count_model_params(model):
     return sum([p.numel() for p in model.parameters()]) / 1e6
 
@@ -252,8 +322,8 @@ class SDModel(torch.nn.Module):
         self.proj = proj
         self.adapter_modules = adapter_modules
 
-    def forward(self, encoder_hidden_states, latents, ref_latents, clip_image_embeddings, timesteps):
-        ref_timesteps = torch.zeros_like(timesteps)
+    def reference_hidden_states(self, ref_latents, clip_image_embeddings):
+        ref_timesteps = torch.zeros(ref_latents.shape[0], dtype=torch.long, device=ref_latents.device)
         cloth_proj_embed = self.proj(clip_image_embeddings)
 
         _ = self.ref_unet(
@@ -262,10 +332,17 @@ class SDModel(torch.nn.Module):
             cloth_proj_embed,
             return_dict=False,
         )
-        # get cache tensors
+        # get cache tensors, only the self-attention ones are read by the unet
         sa_hidden_states = {}
         for name in self.ref_unet.attn_processors.keys():
-            sa_hidden_states[name] = self.ref_unet.attn_processors[name].cache["hidden_states"]
+            if name.endswith("attn1.processor"):
+                sa_hidden_states[name] = self.ref_unet.attn_processors[name].cache["hidden_states"]
+        return sa_hidden_states
+
+    def forward(self, encoder_hidden_states, latents, ref_latents, clip_image_embeddings, timesteps,
+                sa_hidden_states=None):
+        if sa_hidden_states is None:
+            sa_hidden_states = self.reference_hidden_states(ref_latents, clip_image_embeddings)
 
         # get noise predictions
         # Predict the noise residual and compute loss
@@ -373,14 +450,17 @@ def main():
     text_encoder.requires_grad_(False)
     unet.requires_grad_(False)
     image_encoder.requires_grad_(False)
-    image_proj.requires_grad_(True)
-    ref_unet.requires_grad_(True)
+    image_proj.requires_grad_(not args.freeze_reference)
+    ref_unet.requires_grad_(not args.freeze_reference)
     adapter_modules.requires_grad_(True)
     sd_model = SDModel(unet, ref_unet, image_proj, adapter_modules)
 
 
-    params_to_opt = itertools.chain(sd_model.proj.parameters(), sd_model.ref_unet.parameters(),
-                                    sd_model.adapter_modules.parameters())
+    if args.freeze_reference:
+        params_to_opt = sd_model.adapter_modules.parameters()
+    else:
+        params_to_opt = itertools.chain(sd_model.proj.parameters(), sd_model.ref_unet.parameters(),
+                                        sd_model.adapter_modules.parameters())
     accelerator.print("Trainable parameters: proj:{:.2f}M, ref_unet:{:.2f}M, adapter_modules:{:.2f}M".format(
         count_model_params(sd_model.proj), count_model_params(sd_model.ref_unet),
         count_model_params(sd_model.adapter_modules)))
@@ -406,19 +486,38 @@ def main():
         timestep_spacing="trailing", prediction_type="epsilon",
     )
 
-    dataset = VDDataset(
-        [
-            args.dataset_json_path,
-        ],
-        tokenizer,
-    )
+    if args.dataset_shard_dir is not None:
+        # shards are split over ranks by the dataset itself
+        dataset = VDShardDataset(
+            args.dataset_shard_dir,
+            tokenizer,
+            rank=accelerator.process_index,
+            world_size=accelerator.num_processes,
+            seed=args.seed or 0,
+            gpu_decode=args.gpu_decode,
+        )
+        train_sampler = None
+    else:
+        dataset = VDDataset(
+            [
+                args.dataset_json_path,
+            ],
+            tokenizer,
+            feature_dir=args.feature_dir,
+            pretokenize=args.pretokenize_captions,
+            gpu_decode=args.gpu_decode,
+        )
 
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        dataset, num_replicas=accelerator.num_processes, rank=accelerator.process_index, shuffle=True
-    )
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, num_replicas=accelerator.num_processes, rank=accelerator.process_index, shuffle=True
+        )
     train_dataloader = torch.utils.data.DataLoader(
-        dataset, sampler=train_sampler, collate_fn=collate_fn, batch_size=args.train_batch_size, num_workers=4,
+        dataset, sampler=train_sampler, collate_fn=collate_fn, batch_size=args.train_batch_size,
+        num_workers=args.dataloader_num_workers,
     )
+    image_decoder = None
+    if args.gpu_decode and args.feature_dir is None:
+        image_decoder = BatchImageDecoder(dataset.clip_image_processor, accelerator.device)
 
     if accelerator.state.deepspeed_plugin is not None:
         # here we use agrs.gradient_accumulation_steps
@@ -467,9 +566,10 @@ def main():
     # For mixed precision training we cast the text_encoder and vae weights to half-precision
     # as these models are only used for inference, keeping weights in full precision is not required.
     # text_encoder.to(accelerator.device, dtype=weight_dtype)
-    text_encoder.to(accelerator.device, dtype=weight_dtype)
-    vae.to(accelerator.device, dtype=weight_dtype)
-    image_encoder.to(accelerator.device, dtype=weight_dtype)
+    if args.feature_dir is None:
+        text_encoder.to(accelerator.device, dtype=weight_dtype)
+        vae.to(accelerator.device, dtype=weight_dtype)
+        image_encoder.to(accelerator.device, dtype=weight_dtype)
 
     # Figure out how many steps we should save the Accelerator states
     if hasattr(args.checkpointing_steps, "isdigit"):
@@ -509,23 +609,127 @@ def main():
         starting_epoch = last_epoch
         global_steps = last_global_step
 
-    for epoch in range(starting_epoch, args.num_train_epochs):
-        unet.train()
-        train_loss = 0.0
-        step = 0
-        begin = time.perf_counter()
-        for batch in train_dataloader:
-            load_data_time = time.perf_counter() - begin
-            # Convert images to latent space
+    # cached garments need a deterministic reference latent, see --reference_cache_size
+    reference_cache = None
+    if args.freeze_reference and args.reference_cache_size > 0:
+        reference_cache = GarmentFeatureCache(
+            max_gpu_items=args.reference_cache_size, max_cpu_items=args.reference_cache_cpu_size)
+
+    def encode_batch(batch):
+        # Convert images to latent space
+        if "person_moments" in batch:
+            # precomputed latent distributions, only the sampling is left
+            latents = DiagonalGaussianDistribution(
+                batch["person_moments"].to(accelerator.device, dtype=weight_dtype)).sample()
+            latents = latents * 0.18215
+
+            ref_latents = DiagonalGaussianDistribution(
+                batch["clothes_moments"].to(accelerator.device, dtype=weight_dtype))
+            ref_latents = ref_latents.sample() if reference_cache is None else ref_latents.mode()
+            ref_latents = ref_latents * 0.18215
+        else:
             with torch.no_grad():
                 latents = vae.encode(
                     batch["vae_person"].to(accelerator.device, dtype=weight_dtype)).latent_dist.sample()
                 latents = latents * 0.18215
 
                 ref_latents = vae.encode(
-                    batch["vae_clothes"].to(accelerator.device, dtype=weight_dtype)).latent_dist.sample()
+                    batch["vae_clothes"].to(accelerator.device, dtype=weight_dtype)).latent_dist
+                ref_latents = ref_latents.sample() if reference_cache is None else ref_latents.mode()
                 ref_latents = ref_latents * 0.18215
 
+        if "image_embeds" in batch:
+            # dropped images / captions already point to the null embeddings
+            image_embeds = batch["image_embeds"].to(accelerator.device, dtype=weight_dtype)
+            encoder_hidden_states = batch["encoder_hidden_states"].to(accelerator.device, dtype=weight_dtype)
+        else:
+            clip_images = []
+            for clip_image, drop_image_embed in zip(batch["clip_image"], batch["drop_image_embed"]):
+                if drop_image_embed == 1:
+                    clip_images.append(torch.zeros_like(clip_image))
+                else:
+                    clip_images.append(clip_image)
+            clip_images = torch.stack(clip_images, dim=0)
+
+            with torch.no_grad():
+                # print()
+                image_embeds = image_encoder(clip_images.to(accelerator.device, dtype=weight_dtype),
+                                             output_hidden_states=True).hidden_states[-2]
+
+            if "caption_ids" in batch:
+                batch["input_ids"] = dataset.caption_input_ids(batch["caption_ids"])
+            with torch.no_grad():
+                encoder_hidden_states = text_encoder(batch["input_ids"].to(accelerator.device))[0]
+        return latents, ref_latents, image_embeds, encoder_hidden_states
+
+    @torch.no_grad()
+    def reference_hidden_states(ref_latents, image_embeds, keys):
+        # frozen ref_unet: one reference pass over every micro-batch, garments found in the cache are skipped
+        model = accelerator.unwrap_model(sd_model)
+
+        def run_reference(ref_latents, image_embeds):
+            # the unwrapped model skips the autocast of the prepared forward, e.g. fp32 weights with fp16 latents
+            with accelerator.autocast():
+                return model.reference_hidden_states(ref_latents, image_embeds)
+
+        sizes = [len(latents) for latents in ref_latents]
+        ref_latents = torch.cat(ref_latents)
+        image_embeds = torch.cat(image_embeds)
+
+        if reference_cache is None:
+            sa_hidden_states = run_reference(ref_latents, image_embeds)
+        else:
+            samples = [reference_cache.get(key, accelerator.device) for key in keys]
+            missing = [i for i, sample in enumerate(samples) if sample is None]
+            if len(missing) > 0:
+                computed = run_reference(ref_latents[missing], image_embeds[missing])
+                for j, i in enumerate(missing):
+                    samples[i] = {name: states[j:j + 1].clone() for name, states in computed.items()}
+                    reference_cache.put(keys[i], samples[i])
+            sa_hidden_states = {name: torch.cat([sample[name] for sample in samples]) for name in samples[0]}
+
+        chunks = zip(*[states.split(sizes) for states in sa_hidden_states.values()])
+        return [dict(zip(sa_hidden_states.keys(), chunk)) for chunk in chunks]
+
+    def reference_batches():
+        # yields (batch, inputs, seconds spent encoding and in the reference pass), the latter on the first
+        # micro-step of a group only, so it can be kept out of data_time
+        for group in grouped(train_dataloader, args.gradient_accumulation_steps):
+            for batch in group:
+                if "person_bytes" in batch:
+                    batch.update(image_decoder(batch))
+            ref_begin = time.perf_counter()
+            inputs = [encode_batch(batch) for batch in group]
+            keys = None
+            if reference_cache is not None:
+                # the dropped image embedding changes the reference features of the same crop
+                keys = [f"{key}:{drop}" for batch in group
+                        for key, drop in zip(batch["clothes_key"], batch["drop_image_embed"])]
+            sa_hidden_states = reference_hidden_states([x[1] for x in inputs], [x[2] for x in inputs], keys)
+            ref_time = time.perf_counter() - ref_begin
+            for batch, x, states in zip(group, inputs, sa_hidden_states):
+                yield batch, x + (states,), ref_time
+                ref_time = 0.
+
+    for epoch in range(starting_epoch, args.num_train_epochs):
+        if isinstance(dataset, VDShardDataset):
+            dataset.set_epoch(epoch)
+        unet.train()
+        train_loss = 0.0
+        step = 0
+        begin = time.perf_counter()
+        if args.freeze_reference:
+            batches = reference_batches()
+        else:
+            batches = ((batch, None, 0.) for batch in train_dataloader)
+        for batch, inputs, ref_time in batches:
+            if inputs is None and "person_bytes" in batch:
+                batch.update(image_decoder(batch))
+            load_data_time = time.perf_counter() - begin - ref_time
+            if inputs is None:
+                inputs = encode_batch(batch) + (None,)
+            latents, ref_latents, image_embeds, encoder_hidden_states, sa_hidden_states = inputs
+
             # Sample noise that we'll add to the latents
             noise = torch.randn_like(latents)
             if args.noise_offset > 0:
@@ -543,22 +747,6 @@ def main():
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
 
-            clip_images = []
-            for clip_image, drop_image_embed in zip(batch["clip_image"], batch["drop_image_embed"]):
-                if drop_image_embed == 1:
-                    clip_images.append(torch.zeros_like(clip_image))
-                else:
-                    clip_images.append(clip_image)
-            clip_images = torch.stack(clip_images, dim=0)
-
-            with torch.no_grad():
-                # print()
-                image_embeds = image_encoder(clip_images.to(accelerator.device, dtype=weight_dtype),
-                                             output_hidden_states=True).hidden_states[-2]
-
-            with torch.no_grad():
-                encoder_hidden_states = text_encoder(batch["input_ids"].to(accelerator.device))[0]
-
             if noise_scheduler.prediction_type == "epsilon":
                 target = noise
             elif noise_scheduler.prediction_type == "v_prediction":
@@ -570,7 +758,8 @@ def main():
                     f"Unknown prediction type {noise_scheduler.prediction_type}"
                 )
 
-            model_pred = sd_model(encoder_hidden_states, noisy_latents, ref_latents, image_embeds, timesteps)
+            model_pred = sd_model(encoder_hidden_states, noisy_latents, ref_latents, image_embeds, timesteps,
+                                  sa_hidden_states)
 
             if args.snr_gamma == 0:
 
@@ -614,9 +803,9 @@ def main():
 
             if accelerator.is_main_process:
                 logging.info(
-                    "Epoch {}, step {},  step_loss: {}, lr: {}, time: {}, data_time: {}".format(
+                    "Epoch {}, step {},  step_loss: {}, lr: {}, time: {}, data_time: {}, ref_time: {}".format(
                         epoch, global_steps, loss.detach().item(), lr_scheduler.get_lr()[0],
-                        time.perf_counter() - begin, load_data_time)
+                        time.perf_counter() - begin, load_data_time, ref_time)
                 )
             global_steps += 1
             step += 1